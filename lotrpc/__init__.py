@@ -2,6 +2,12 @@ from .server import *
 from .client import *
 from .proxy import *
 from .proxyauth import *
+from .tokenstore import *
+from .metrics import *
+from .profiling import *
+from .cache import *
+from .balance import *
+from .batch import *
 from .dispatcher import *
 # from . import bson
 from . import json
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import queue
+import random
+import threading
+from logging import getLogger, INFO, FileHandler, Formatter
+
+log = getLogger(__name__)
+access_log = getLogger("lotrpc.access")
+
+
+class AccessLog:
+    # the request path only samples and enqueues references, a writer thread
+    # formats and emits to the "lotrpc.access" logger (and "file", if given).
+    # params:
+    #   sample: fraction of requests logged (1.0)
+    #   payload: full, truncate (default), size (lengths only) or none
+    #   max_bytes: truncate params/result to this (256)
+    #   format: text (default) or json (one JSON object per line)
+    #   queue_size: pending entries, more are dropped and counted (10000)
+    #   file: also write lines to this file
+    def __init__(self, params: dict = {}):
+        self.sample = params.get("sample", 1.0)
+        self.payload = params.get("payload", "truncate")
+        self.max_bytes = params.get("max_bytes", 256)
+        self.json = params.get("format", "text") == "json"
+        self.queue = queue.Queue(params.get("queue_size", 10000))
+        self.file = params.get("file", None)
+        self.dropped = 0
+        self.dropped_warn = 0.0
+        self.writer_pid = None
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        # checked per request: cheap when the access logger is off or not sampled
+        if not access_log.isEnabledFor(INFO):
+            return False
+        return self.sample >= 1.0 or random.random() < self.sample
+
+    def put(self, method, params, result, elapsed, error=None):
+        self.start_writer()
+        try:
+            self.queue.put_nowait((time.time(), method, params, result, elapsed, error))
+        except queue.Full:
+            self.dropped += 1
+
+    def start_writer(self):
+        # one thread per process (threads do not survive fork)
+        if self.writer_pid != os.getpid():
+            with self.lock:
+                if self.writer_pid != os.getpid():
+                    threading.Thread(target=self.writer, daemon=True).start()
+                    self.writer_pid = os.getpid()
+
+    def writer(self):
+        fh = None
+        if self.file is not None:
+            fh = FileHandler(self.file)
+            fh.setFormatter(Formatter("%(message)s"))
+        while True:
+            ent = self.queue.get()
+            try:
+                line = self.format(*ent)
+                if self.dropped and ent[0] - self.dropped_warn > 10:
+                    # at most every 10 seconds
+                    n, self.dropped = self.dropped, 0
+                    self.dropped_warn = ent[0]
+                    log.warning("access log: %d entries dropped", n)
+                rec = access_log.makeRecord(access_log.name, INFO, __file__, 0, line, (), None)
+                rec.created = ent[0]
+                access_log.handle(rec)
+                if fh is not None:
+                    fh.handle(rec)
+            except Exception as e:
+                log.warning("access log: %s", e)
+
+    def encode(self, v):
+        if self.payload == "none":
+            return None
+        s = json.dumps(v, ensure_ascii=False, default=repr)
+        if self.payload == "size":
+            return len(s)
+        if self.payload == "truncate" and len(s) > self.max_bytes:
+            return s[:self.max_bytes] + "...({} bytes)".format(len(s))
+        return s
+
+    def format(self, ts, method, params, result, elapsed, error):
+        p = self.encode(params)
+        r = self.encode(result) if error is None else None
+        if self.json:
+            ent = {"ts": ts, "method": method, "elapsed_ms": round(elapsed * 1000, 3),
+                   "status": "ok" if error is None else "error"}
+            if error is not None:
+                ent["error"] = str(error)
+            if self.payload == "size":
+                ent["params_size"] = p
+                ent["result_size"] = r
+            elif self.payload != "none":
+                ent["params"] = p
+                ent["result"] = r
+            return json.dumps(ent, ensure_ascii=False)
+        res = "{} {:.3f}ms {}".format(method, elapsed * 1000, "ok" if error is None else "error")
+        if error is not None:
+            res += " error={}".format(error)
+        if self.payload == "size":
+            res += " params_size={} result_size={}".format(p, r)
+        elif self.payload != "none":
+            res += " params={} result={}".format(p, r)
+        return res
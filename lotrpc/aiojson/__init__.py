@@ -1 +1 @@
-from .rpc import Server, Client
+from .rpc import Server, Client, AsyncClient
@@ -4,14 +4,18 @@ from aiohttp_xmlrpc.handler import XMLRPCView
 from aiohttp_xmlrpc.client import ServerProxy
 from aiohttp import web
 
-from ..client import ClientIf
+from ..client import ClientIf, AsyncClientIf
 from ..server import ServerIf
+from ..dispatcher import is_async
 
 
 class Server(ServerIf):
     class MyHandler(XMLRPCView):
         def _d1(self, method, **params):
-            return self.d(method, params)
+            if is_async(self.d, method):
+                return self.d(method, params)
+            # sync handlers must not block the event loop
+            return asyncio.wrap_future(self.srv.submit(method, params))
 
         def _lookup_method(self, method_name):
             res = functools.partial(self._d1, method_name)
@@ -20,22 +24,55 @@ class Server(ServerIf):
             return res
 
     def serve(self, dispatcher):
-        hdl = type("CustomHandler", (self.MyHandler,), {"d": dispatcher})
+        dispatcher = self.wrap_dispatcher(dispatcher)
+        if self.prefork(dispatcher):
+            return
+        self.start_executor(dispatcher)
+        hdl = type("CustomHandler", (self.MyHandler,), {"d": dispatcher, "srv": self})
         app = web.Application()
         app.router.add_route('*', self.addr_parsed.path, hdl)
-        web.run_app(app, host=self.addr_parsed.hostname,
-                    port=self.addr_parsed.port)
+        if self.sock is not None:
+            web.run_app(app, sock=self.sock)
+        else:
+            web.run_app(app, host=self.addr_parsed.hostname,
+                        port=self.addr_parsed.port)
+
+
+async def new_proxy(addr):
+    # the aiohttp session must be created on a running loop
+    return ServerProxy(addr)
 
 
 class Client(ClientIf):
     def __init__(self, addr: str, params: dict = {}):
         super().__init__(addr, params)
-        self.cl = ServerProxy(self.addr)
         self.loop = asyncio.get_event_loop()
+        self.cl = self.loop.run_until_complete(new_proxy(self.addr))
 
     def call(self, method: str, params=None):
-        res = self.cl[method](params)
-        return self.loop.run_until_complete(res)
+        fn = self.cl
+        for k in method.split("."):
+            fn = getattr(fn, k)
+        return self.loop.run_until_complete(fn(params))
 
     def __del__(self):
         return self.loop.run_until_complete(self.cl.close())
+
+
+class AsyncClient(AsyncClientIf):
+    def __init__(self, addr: str, params: dict = {}):
+        super().__init__(addr, params)
+        self.cl = None
+
+    async def call(self, method: str, params=None):
+        if self.cl is None:
+            self.cl = ServerProxy(self.addr)
+        fn = self.cl
+        for k in method.split("."):
+            fn = getattr(fn, k)
+        return await fn(params)
+
+    async def close(self):
+        if self.cl is not None:
+            await self.cl.close()
+            self.cl = None
@@ -0,0 +1,224 @@
+import time
+import bisect
+import hashlib
+import threading
+import itertools
+from logging import getLogger
+from .client import ClientIf
+
+log = getLogger(__name__)
+
+
+class Upstream:
+    def __init__(self, client, ewma_alpha=0.2):
+        self.client = client
+        self.addr = client.addr
+        self.alpha = ewma_alpha
+        self.outstanding = 0
+        self.fails = 0              # consecutive failures
+        self.ejected_until = None   # None: in service
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.ewma = None
+        self.max = 0.0
+
+    def record(self, elapsed, ok):
+        # with BalancedClient.lock held
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if self.ewma is None:
+            self.ewma = elapsed
+        else:
+            self.ewma += self.alpha * (elapsed - self.ewma)
+        if ok:
+            self.fails = 0
+        else:
+            self.errors += 1
+            self.fails += 1
+
+    def stats(self):
+        return {
+            "addr": self.addr,
+            "count": self.count,
+            "errors": self.errors,
+            "outstanding": self.outstanding,
+            "avg_ms": 1000 * self.total / self.count if self.count else None,
+            "ewma_ms": 1000 * self.ewma if self.ewma is not None else None,
+            "max_ms": 1000 * self.max,
+            "ejected": self.ejected_until is not None,
+        }
+
+
+def hash_ring(upstreams, vnodes):
+    ring = []
+    for i, u in enumerate(upstreams):
+        for v in range(vnodes):
+            ring.append((ring_hash("{}#{}".format(u.addr, v)), i))
+    ring.sort()
+    return ring
+
+
+def ring_hash(s):
+    return int.from_bytes(hashlib.md5(s.encode("utf-8")).digest()[:8], "big")
+
+
+class BalancedClient(ClientIf):
+    # one client per upstream. params:
+    #   strategy: round_robin (default), least_outstanding, hash (consistent hash by method)
+    #   retries: other upstreams to try when a call fails with a connection error (1)
+    #   max_fails: consecutive failures before ejection (3)
+    #   slow_ms: eject when the latency average (ewma) goes over this (None: off)
+    #   eject_time: seconds out of service before a retry (10)
+    #   health_method, health_params, health_interval: probe ejected upstreams with this
+    #     method instead of waiting eject_time
+    #   vnodes: points per upstream on the hash ring (100)
+    # a failure is an OSError (connection refused/reset, timeouts, requests errors)
+    stats_method = "_lotrpc.upstream.stats"
+    failure = (OSError, )
+
+    def __init__(self, clients, params: dict = {}):
+        super().__init__(",".join(x.addr for x in clients), params)
+        if len(clients) == 0:
+            raise Exception("no upstream")
+        self.upstreams = [Upstream(x) for x in clients]
+        self.strategy = self.params.get("strategy", "round_robin")
+        self.retries = self.params.get("retries", 1)
+        self.max_fails = self.params.get("max_fails", 3)
+        self.slow = self.params.get("slow_ms", None)
+        self.eject_time = self.params.get("eject_time", 10)
+        self.health_method = self.params.get("health_method", None)
+        self.health_params = self.params.get("health_params", {})
+        self.health_interval = self.params.get("health_interval", 1)
+        self.select = getattr(self, "select_" + self.strategy, None)
+        if self.select is None:
+            raise Exception("unknown strategy: {}".format(self.strategy))
+        self.lock = threading.Lock()
+        self.rr = itertools.count()
+        self.ring = hash_ring(self.upstreams, self.params.get("vnodes", 100))
+        self.ring_keys = [x[0] for x in self.ring]
+        self.stopped = threading.Event()
+        if self.health_method is not None:
+            threading.Thread(target=self.health_check, daemon=True).start()
+
+    @classmethod
+    def from_addrs(cls, mod, addrs, client_params: dict = {}, params: dict = {}):
+        # mod: backend module (lotrpc.json, ...), addrs: list or comma separated
+        if isinstance(addrs, str):
+            addrs = addrs.split(",")
+        return cls([mod.Client(x, client_params) for x in addrs], params)
+
+    def available(self, now, exclude):
+        # with self.lock held
+        res = []
+        for i, u in enumerate(self.upstreams):
+            if i in exclude:
+                continue
+            if u.ejected_until is not None:
+                if self.health_method is not None or now < u.ejected_until:
+                    continue
+                # passive: let one request through, eject again on failure
+                log.info("retry upstream %s", u.addr)
+                u.ejected_until = None
+                u.fails = self.max_fails - 1
+            res.append(i)
+        return res
+
+    def select_round_robin(self, method, cand):
+        return cand[next(self.rr) % len(cand)]
+
+    def select_least_outstanding(self, method, cand):
+        # ties go round robin
+        r = next(self.rr)
+        n = len(self.upstreams)
+        return min(cand, key=lambda i: (self.upstreams[i].outstanding, (i - r) % n))
+
+    def select_hash(self, method, cand):
+        # next point on the ring clockwise whose upstream is available
+        pos = bisect.bisect(self.ring_keys, ring_hash(method))
+        cset = set(cand)
+        for n in range(len(self.ring)):
+            i = self.ring[(pos + n) % len(self.ring)][1]
+            if i in cset:
+                return i
+        return cand[0]
+
+    def pick(self, method, exclude):
+        with self.lock:
+            cand = self.available(time.monotonic(), exclude)
+            if len(cand) == 0:
+                return None
+            i = self.select(method, cand)
+            self.upstreams[i].outstanding += 1
+            return i
+
+    def done(self, i, elapsed, ok):
+        u = self.upstreams[i]
+        with self.lock:
+            u.outstanding -= 1
+            u.record(elapsed, ok)
+            if u.ejected_until is not None:
+                return
+            if all(x.ejected_until is not None for x in self.upstreams if x is not u):
+                # keep the last one in service
+                return
+            if u.fails >= self.max_fails:
+                reason = "failed {} times".format(u.fails)
+            elif self.slow is not None and u.ewma * 1000 > self.slow:
+                reason = "slow ({:.1f}ms)".format(u.ewma * 1000)
+            else:
+                return
+            u.ejected_until = time.monotonic() + self.eject_time
+            u.ewma = None
+        log.warning("eject upstream %s: %s", u.addr, reason)
+
+    def call(self, method: str, params=None):
+        if method == self.stats_method:
+            return self.stats()
+        tried = set()
+        while True:
+            i = self.pick(method, tried)
+            if i is None:
+                raise Exception("no upstream available")
+            tried.add(i)
+            ts = time.perf_counter()
+            try:
+                res = self.upstreams[i].client.call(method, params)
+            except self.failure as e:
+                self.done(i, time.perf_counter() - ts, False)
+                log.debug("upstream %s failed: %s", self.upstreams[i].addr, e)
+                if len(tried) > self.retries:
+                    raise
+                continue
+            except Exception:
+                # rpc error from a working upstream
+                self.done(i, time.perf_counter() - ts, True)
+                raise
+            self.done(i, time.perf_counter() - ts, True)
+            return res
+
+    def health_check(self):
+        while not self.stopped.wait(self.health_interval):
+            for u in self.upstreams:
+                if u.ejected_until is None:
+                    continue
+                try:
+                    u.client.call(self.health_method, self.health_params)
+                except Exception as e:
+                    log.debug("health check %s: %s", u.addr, e)
+                    continue
+                log.info("upstream %s is back", u.addr)
+                with self.lock:
+                    u.ejected_until = None
+                    u.fails = 0
+
+    def stats(self):
+        with self.lock:
+            return [u.stats() for u in self.upstreams]
+
+    def close(self):
+        self.stopped.set()
+        for u in self.upstreams:
+            if hasattr(u.client, "close"):
+                u.client.close()
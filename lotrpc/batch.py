@@ -0,0 +1,113 @@
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+from .client import ClientIf
+
+log = getLogger(__name__)
+
+
+class BatchingClient(ClientIf):
+    # collects calls from many threads for window_ms (or max_batch calls) and sends
+    # them upstream at once:
+    #   call_batch(calls) -> results (json): one request per batch
+    #   submit_many(calls) -> futures (msgpack): one write, replies pipelined
+    # params: window_ms (2), max_batch (64), max_inflight (4) batches being sent,
+    #   timeout: seconds a call waits for its reply (the wrapped client's timeout)
+    def __init__(self, client, params: dict = {}):
+        super().__init__(client.addr, params)
+        self.client = client
+        self.window = self.params.get("window_ms", 2) / 1000.0
+        self.max_batch = self.params.get("max_batch", 64)
+        self.timeout = self.params.get("timeout", getattr(client, "timeout", None))
+        self.queue = []     # (method, params, future)
+        self.cond = threading.Condition()
+        self.closed = False
+        if hasattr(client, "call_batch"):
+            self.send = self.send_batch
+            self.pool = ThreadPoolExecutor(self.params.get("max_inflight", 4))
+        elif hasattr(client, "submit_many"):
+            self.send = self.send_pipeline
+            self.pool = None
+        else:
+            log.warning("%s cannot batch, calls are passed through", type(client).__name__)
+            self.send = None
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def call(self, method: str, params=None):
+        if self.send is None:
+            return self.client.call(method, params)
+        ft = Future()
+        with self.cond:
+            if self.closed:
+                raise Exception("closed")
+            self.queue.append((method, params, ft))
+            if len(self.queue) == 1 or len(self.queue) >= self.max_batch:
+                self.cond.notify()
+        return ft.result(self.timeout)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed and not self.queue:
+                    return
+                # the first call opens the window
+                deadline = time.monotonic() + self.window
+                while len(self.queue) < self.max_batch and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.queue[:self.max_batch]
+                del self.queue[:self.max_batch]
+            log.debug("send %d calls", len(batch))
+            if self.pool is not None:
+                self.pool.submit(self.send, batch)
+            else:
+                self.send(batch)
+
+    def send_batch(self, batch):
+        try:
+            res = self.client.call_batch([(m, p) for m, p, _ in batch])
+        except Exception as e:
+            for _, _, ft in batch:
+                ft.set_exception(e)
+            return
+        for (_, _, ft), r in zip(batch, res):
+            if isinstance(r, Exception):
+                ft.set_exception(r)
+            else:
+                ft.set_result(r)
+
+    def send_pipeline(self, batch):
+        try:
+            fts = self.client.submit_many([(m, p) for m, p, _ in batch])
+        except Exception as e:
+            for _, _, ft in batch:
+                ft.set_exception(e)
+            return
+        for (_, _, ft), uft in zip(batch, fts):
+            uft.add_done_callback(lambda x, ft=ft: copy_future(x, ft))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.send is not None:
+            self.thread.join()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if hasattr(self.client, "close"):
+            self.client.close()
+
+
+def copy_future(src, dst):
+    e = src.exception()
+    if e is not None:
+        dst.set_exception(e)
+    else:
+        dst.set_result(src.result())
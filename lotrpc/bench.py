@@ -0,0 +1,276 @@
+# cross-protocol benchmark: a local server per backend, payload size x concurrency sweep
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import platform
+import threading
+import subprocess
+from logging import getLogger
+from .dispatcher import SimpleDispatcher
+from .metrics import perf_counter_ns
+from .version import VERSION
+
+log = getLogger(__name__)
+
+modes = ["json", "xml", "msgpack", "mp", "zero", "grpc", "aiojson", "aioxml"]
+quantiles = (("p50_ms", 0.5), ("p99_ms", 0.99), ("p999_ms", 0.999))
+
+
+class EchoDispatcher(SimpleDispatcher):
+    def do_echo(self, params):
+        return params
+
+    def do_Greeter_SayHello(self, params):
+        return {"message": params.get("name", "")}
+
+
+server_script = """
+import sys, json, lotrpc, lotrpc.bench
+mod = getattr(lotrpc, sys.argv[1])
+mod.Server(sys.argv[2], json.loads(sys.argv[3])).serve(lotrpc.bench.EchoDispatcher())
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_payload(size, kind="string"):
+    # string: {"name": "xxx..."} (every backend, grpc hello.proto too),
+    # struct: a list of small records, roughly size bytes as JSON
+    if kind == "string":
+        return {"name": "x" * size}
+    item = {"id": 12345, "name": "xyzxyz", "flag": True, "value": 1.5, "tags": ["a", "b"]}
+    return {"items": [item] * max(1, size // len(json.dumps(item)))}
+
+
+def percentile(lat, q):
+    # lat: sorted
+    return lat[min(len(lat) - 1, int(q * len(lat)))]
+
+
+class Suite:
+    # params:
+    #   modes, sizes, concurrency: what to sweep
+    #   duration: seconds per run (2), warmup: calls before each run (20)
+    #   payload: string (default) or struct
+    #   server_options, client_options: for every backend
+    #   grpc_source: proto with Greeter.SayHello (examples/grpc/hello.proto)
+    #   start_timeout: seconds to wait for a server to listen (10)
+    #   call_timeout: client "timeout" unless client_options has one (10). a run whose
+    #     clients are not warm after 2 * call_timeout, or still calling call_timeout after
+    #     its end, is recorded as an error (for clients without a timeout)
+    def __init__(self, params: dict = {}):
+        self.params = params
+        self.modes = params.get("modes", modes)
+        self.sizes = params.get("sizes", [100, 10000])
+        self.concurrency = params.get("concurrency", [1, 16])
+        self.duration = params.get("duration", 2)
+        self.warmup = params.get("warmup", 20)
+        self.payload = params.get("payload", "string")
+        self.grpc_source = params.get("grpc_source", "examples/grpc/hello.proto")
+        self.start_timeout = params.get("start_timeout", 10)
+        self.call_timeout = params.get("call_timeout", 10)
+
+    def options(self, mode, key):
+        opts = dict(self.params.get(key, {}))
+        if mode == "grpc":
+            opts.setdefault("source", self.grpc_source)
+        if key == "client_options":
+            opts.setdefault("timeout", self.call_timeout)
+        return opts
+
+    def method(self, mode):
+        return "Greeter.SayHello" if mode == "grpc" else "echo"
+
+    def start_server(self, mode, addr, port):
+        proc = subprocess.Popen(
+            [sys.executable, "-c", server_script, mode, addr,
+             json.dumps(self.options(mode, "server_options"))],
+            stdout=subprocess.DEVNULL)   # stdout may carry the results
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise Exception("server exited ({})".format(proc.returncode))
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                return proc
+            except OSError:
+                time.sleep(0.1)
+        self.stop_server(proc)
+        raise Exception("server did not start in {}s".format(self.start_timeout))
+
+    def stop_server(self, proc):
+        proc.terminate()
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def new_client(self, mod, mode, addr):
+        # some clients need an event loop in their thread (aiojson)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        return mod.Client(addr, self.options(mode, "client_options"))
+
+    def run_one(self, mod, mode, addr, size, conc):
+        # closed loop: conc threads, each with its own client, call until the deadline
+        method = self.method(mode)
+        if mode == "grpc" and self.payload != "string":
+            raise Exception("grpc supports the string payload only")
+        payload = make_payload(size, self.payload)
+        lats = [[] for _ in range(conc)]
+        errors = [0] * conc
+        failed = []     # warmup errors
+        deadline = [None]
+        # the clock starts when every client is warm
+        ready = threading.Barrier(
+            conc + 1, action=lambda: deadline.__setitem__(0, time.monotonic() + self.duration))
+
+        def worker(idx):
+            cl = None
+            try:
+                cl = self.new_client(mod, mode, addr)
+                for i in range(self.warmup):
+                    cl.call(method, payload)
+            except Exception as e:
+                log.debug("%s warmup: %s", mode, e)
+                failed.append(e)
+                errors[idx] = -1
+            try:
+                ready.wait()
+            except threading.BrokenBarrierError:
+                return      # the run was given up
+            if errors[idx] < 0:
+                return
+            out = lats[idx]
+            while time.monotonic() < deadline[0]:
+                ts = perf_counter_ns()
+                try:
+                    cl.call(method, payload)
+                except Exception as e:
+                    log.debug("%s call: %s", mode, e)
+                    errors[idx] += 1
+                    continue
+                out.append(perf_counter_ns() - ts)
+            if hasattr(cl, "close"):
+                cl.close()
+        threads = [threading.Thread(target=worker, args=(i, ), daemon=True) for i in range(conc)]
+        for t in threads:
+            t.start()
+        try:
+            ready.wait(2 * self.call_timeout)
+        except threading.BrokenBarrierError:
+            # hung clients are daemon threads, stopping the server ends them
+            raise Exception("clients not ready in {}s".format(2 * self.call_timeout))
+        ts = time.monotonic()
+        for t in threads:
+            t.join(max(0, deadline[0] + self.call_timeout - time.monotonic()))
+        elapsed = time.monotonic() - ts
+        if any(t.is_alive() for t in threads):
+            raise Exception("calls did not return in {}s".format(self.call_timeout))
+        if len(failed) == conc:
+            raise Exception("no client could call {}: {!r}".format(method, failed[0]))
+        lat = sorted(x for y in lats for x in y)
+        res = {
+            "requests": len(lat),
+            "errors": sum(x for x in errors if x > 0),
+            "seconds": elapsed,
+            "rps": len(lat) / elapsed,
+        }
+        if lat:
+            res["mean_ms"] = sum(lat) / len(lat) / 1e6
+            for name, q in quantiles:
+                res[name] = percentile(lat, q) / 1e6
+            res["max_ms"] = lat[-1] / 1e6
+        return res
+
+    def run_mode(self, mode):
+        import lotrpc
+        try:
+            mod = getattr(lotrpc, mode)
+        except AttributeError:
+            yield {"mode": mode, "error": "unknown mode"}
+            return
+        port = free_port()
+        addr = "http://127.0.0.1:{}/".format(port)
+        try:
+            proc = self.start_server(mode, addr, port)
+        except Exception as e:
+            yield {"mode": mode, "error": str(e)}
+            return
+        try:
+            for size in self.sizes:
+                for conc in self.concurrency:
+                    ent = {"mode": mode, "size": size, "concurrency": conc}
+                    try:
+                        ent.update(self.run_one(mod, mode, addr, size, conc))
+                    except Exception as e:
+                        ent["error"] = str(e)
+                    yield ent
+        finally:
+            self.stop_server(proc)
+
+    def run(self):
+        # -> {"meta": {...}, "results": [...]}, results are also logged as they come
+        results = []
+        for mode in self.modes:
+            for ent in self.run_mode(mode):
+                log.info("%s", format_result(ent))
+                results.append(ent)
+        return {"meta": self.meta(), "results": results}
+
+    def meta(self):
+        return {
+            "version": VERSION,
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.time(),
+            "params": {
+                "modes": self.modes, "sizes": self.sizes, "concurrency": self.concurrency,
+                "duration": self.duration, "payload": self.payload,
+                "call_timeout": self.call_timeout,
+            },
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def format_result(ent):
+    head = "%-8s %7s %4s" % (ent["mode"], ent.get("size", "-"), ent.get("concurrency", "-"))
+    if "error" in ent:
+        return "%s  error: %s" % (head, ent["error"])
+    if ent["requests"] == 0:
+        return "%s  no successful calls (%d errors)" % (head, ent["errors"])
+    return "%s %9.1f rps  p50 %7.3f  p99 %7.3f  p999 %7.3f ms  errors %d" % (
+        head, ent["rps"], ent["p50_ms"], ent["p99_ms"], ent["p999_ms"], ent["errors"])
+
+
+def compare(old, new):
+    # lines of rps and p99 ratios (new / old) for runs present in both
+    def key(x):
+        return x["mode"], x.get("size"), x.get("concurrency")
+    prev = {key(x): x for x in old["results"] if "error" not in x and x["requests"]}
+    out = ["%-8s %7s %4s %9s %9s" % ("mode", "size", "conc", "rps", "p99")]
+    for x in new["results"]:
+        o = prev.get(key(x))
+        if o is None or "error" in x or x["requests"] == 0:
+            continue
+        out.append("%-8s %7s %4s %8.2fx %8.2fx" % (
+            x["mode"], x["size"], x["concurrency"],
+            x["rps"] / o["rps"], x["p99_ms"] / o["p99_ms"]))
+    return out
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from logging import getLogger
+from .client import ClientIf
+
+log = getLogger(__name__)
+
+# keep `json` out of the lotrpc namespace (lotrpc.json is the backend)
+__all__ = ["cache_key", "LRUCache", "SqliteCache", "new_store", "SingleFlight", "CachingClient"]
+
+
+def cache_key(method: str, params=None):
+    # method + canonical params: dict order does not matter, list/tuple are the same.
+    # keys of one method share the prefix method + "\0"
+    return method + "\0" + json.dumps(
+        params, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=repr)
+
+
+class LRUCache:
+    # in-process store: get/set/delete/delete_prefix/clear are thread safe
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.data = OrderedDict()   # key -> (expire, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # -> (found, value)
+        with self.lock:
+            ent = self.data.get(key)
+            if ent is None:
+                return False, None
+            if ent[0] < time.monotonic():
+                del self.data[key]
+                return False, None
+            self.data.move_to_end(key)
+            return True, ent[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.data[key] = (time.monotonic() + ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            return self.data.pop(key, None) is not None
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            keys = [k for k in self.data if k.startswith(prefix)]
+            for k in keys:
+                del self.data[k]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+def sqlite_conn(local, path):
+    # one connection per thread (local: threading.local), reopened after fork
+    conn = getattr(local, "conn", None)
+    if conn is None or local.pid != os.getpid():
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+class SqliteCache:
+    # store shared by processes (pre-forked workers, several proxies) through one file.
+    # values are pickled: keep the file private to the service user.
+    # over max_size, entries closest to expiry are evicted first
+    cleanup_interval = 100  # sets
+
+    def __init__(self, path, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self.local = threading.local()
+        self.sets = 0
+        self.db().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expire REAL, value BLOB)")
+        self.db().execute("CREATE INDEX IF NOT EXISTS cache_expire ON cache (expire)")
+
+    def db(self):
+        return sqlite_conn(self.local, self.path)
+
+    def get(self, key):
+        row = self.db().execute(
+            "SELECT value FROM cache WHERE key=? AND expire>=?", (key, time.time())).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        self.db().execute(
+            "INSERT OR REPLACE INTO cache (key, expire, value) VALUES (?, ?, ?)",
+            (key, time.time() + ttl, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.sets += 1
+        if self.sets % self.cleanup_interval == 0:
+            self.cleanup()
+
+    def cleanup(self):
+        db = self.db()
+        db.execute("DELETE FROM cache WHERE expire<?", (time.time(), ))
+        db.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expire"
+            " LIMIT max(0, (SELECT count(*) FROM cache) - ?))", (self.max_size, ))
+
+    def delete(self, key):
+        return self.db().execute("DELETE FROM cache WHERE key=?", (key, )).rowcount != 0
+
+    def delete_prefix(self, prefix):
+        # keys are method + "\0" + ...: a range scan on the primary key
+        return self.db().execute(
+            "DELETE FROM cache WHERE key>=? AND key<?", (prefix, prefix + "\uffff")).rowcount
+
+    def clear(self):
+        self.db().execute("DELETE FROM cache")
+
+    def __len__(self):
+        return self.db().execute("SELECT count(*) FROM cache").fetchone()[0]
+
+
+def new_store(params: dict = {}):
+    # params: store=memory (default) or sqlite, path (sqlite file), max_size
+    store = params.get("store", "memory")
+    if store == "memory":
+        return LRUCache(params.get("max_size", 10000))
+    if store == "sqlite":
+        return SqliteCache(params.get("path", "lotrpc-cache.db"), params.get("max_size", 100000))
+    raise Exception("unknown cache store: {}".format(store))
+
+
+class SingleFlight:
+    # one upstream call per key at a time, concurrent callers share its result
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def join(self, key):
+        # -> (future, leader). the leader must call done()
+        with self.lock:
+            ft = self.inflight.get(key)
+            if ft is not None:
+                return ft, False
+            ft = self.inflight[key] = Future()
+            return ft, True
+
+    def done(self, key, ft, value=None, error=None):
+        with self.lock:
+            self.inflight.pop(key, None)
+        if error is not None:
+            ft.set_exception(error)
+        else:
+            ft.set_result(value)
+
+
+class CachingClient(ClientIf):
+    # wraps any client. params:
+    #   ttl: {method: seconds} cached methods
+    #   default_ttl: seconds for other methods (None: not cached)
+    #   store, path, max_size: see new_store()
+    # cached results are shared between callers: do not modify them
+    def __init__(self, client, params: dict = {}, store=None):
+        super().__init__(client.addr, params)
+        self.client = client
+        self.ttl = self.params.get("ttl", {})
+        self.default_ttl = self.params.get("default_ttl", None)
+        self.cache = store or new_store(self.params)
+        self.flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_ttl(self, method):
+        return self.ttl.get(method, self.default_ttl)
+
+    def call(self, method: str, params=None):
+        ttl = self.get_ttl(method)
+        if not ttl:
+            return self.client.call(method, params)
+        key = cache_key(method, params)
+        found, value = self.cache.get(key)
+        if found:
+            self.hits += 1
+            return value
+        ft, leader = self.flight.join(key)
+        if not leader:
+            self.coalesced += 1
+            return ft.result()
+        # leader: waiters block until done(), whatever fails below
+        try:
+            found, value = self.cache.get(key)
+        except Exception as e:
+            log.warning("cache get %s: %s", method, e)
+            found = False
+        if found:
+            # the previous leader finished after our first lookup
+            self.hits += 1
+            self.flight.done(key, ft, value)
+            return value
+        self.misses += 1
+        try:
+            value = self.client.call(method, params)
+        except Exception as e:
+            self.flight.done(key, ft, error=e)
+            raise
+        try:
+            self.cache.set(key, value, ttl)
+        except Exception as e:
+            # sqlite locked/full, unpicklable value: still a good result
+            log.warning("cache set %s: %s", method, e)
+        self.flight.done(key, ft, value)
+        return value
+
+    def invalidate(self, method=None, params=None):
+        # all entries, all entries of a method, or one call
+        if method is None:
+            self.cache.clear()
+        elif params is None:
+            self.cache.delete_prefix(method + "\0")
+        else:
+            self.cache.delete(cache_key(method, params))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "coalesced": self.coalesced, "size": len(self.cache)}
+
+    def close(self):
+        if hasattr(self.client, "close"):
+            self.client.close()
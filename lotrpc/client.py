@@ -18,3 +18,14 @@ class ClientIf:
 
     def asynccall(self, loop, method: str, params=None):
         return loop.run_in_executor(None, self.call, method, params)
+
+
+class AsyncClientIf(ClientIf):
+    async def call(self, method: str, params=None):
+        pass
+
+    def asynccall(self, loop, method: str, params=None):
+        return self.call(method, params)
+
+    async def close(self):
+        pass
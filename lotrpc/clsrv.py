@@ -1,14 +1,20 @@
 import lotrpc
+import lotrpc.bench
 import click
 import json
 import time
 import copy
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
 import asyncio
 import inspect
 import queue
 import threading
 from benchmarker import Benchmarker, Skip
-from logging import getLogger, basicConfig, DEBUG
+from logging import getLogger, basicConfig, DEBUG, INFO, StreamHandler
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 log = getLogger(__name__)
@@ -19,6 +25,13 @@ def setupLog(verbose):
         basicConfig(level=DEBUG)
 
 
+def setupAccessLog():
+    alog = getLogger("lotrpc.access")
+    alog.setLevel(INFO)
+    if not alog.hasHandlers():
+        alog.addHandler(StreamHandler())
+
+
 class MyDispatcher(lotrpc.SimpleDispatcher):
     """dispatcher example"""
     seq = 1
@@ -49,6 +62,17 @@ class MyDispatcher(lotrpc.SimpleDispatcher):
         log.debug("say gm to %s", params)
         return {"message": "good morning {}".format(params.get("name", "anonymous"))}
 
+    def do_Counter_Count(self, params):
+        for i in range(params.get("num", 0)):
+            yield {"value": i}
+
+    def do_Counter_Sum(self, params):
+        return {"sum": sum(x.get("value", 0) for x in params)}
+
+    def do_Counter_Echo(self, params):
+        for x in params:
+            yield x
+
     def do_hello(self, params):
         return {"result": "OK"}
 
@@ -77,19 +101,35 @@ def do_call(cl, num, method, params):
     log.debug("call%d %s %s", num, method, params)
     res = []
     for i in range(num):
-        res.append(cl.call(method, params))
+        r = cl.call(method, params)
+        if inspect.isgenerator(r):
+            # streaming response
+            r = list(r)
+        res.append(r)
     return "\n".join(map(str, res))
 
 
+async def do_call_gather(cl, loop, num, method, params):
+    res = await asyncio.gather(*[cl.asynccall(loop, method, copy.deepcopy(params))
+                                 for i in range(num)])
+    if isinstance(cl, lotrpc.AsyncClientIf):
+        await cl.close()
+    return res
+
+
 def do_call_async(cl, num, method, params):
-    res = []
     loop = asyncio.get_event_loop()
-    for i in range(num):
-        res.append(cl.asynccall(loop, method, copy.deepcopy(params)))
-    res = [loop.run_until_complete(x) for x in res]
+    res = loop.run_until_complete(do_call_gather(cl, loop, num, method, params))
     return "\n".join(map(str, res))
 
 
+def new_async_client(mod, addr, options):
+    # native asyncio client if the protocol has one
+    if hasattr(mod, "AsyncClient"):
+        return mod.AsyncClient(addr, options)
+    return mod.Client(addr, options)
+
+
 @click.group(invoke_without_command=True)
 @click.pass_context
 def cli(ctx):
@@ -110,11 +150,15 @@ def listmode():
 @click.option("--options", default="{}")
 @click.argument('mode', default='json')
 @click.argument('addr', default="http://0.0.0.0:9999/")
+@click.option("--workers", type=int, default=None, help="pre-fork worker processes (json, xml, aiojson, aioxml)")
 @click.option("--verbose/--no-verbose", default=False)
-def server(mode, addr, verbose=False, options={}):
+def server(mode, addr, verbose=False, options={}, workers=None):
     setupLog(verbose)
     mod = getattr(lotrpc, mode)
-    srv = mod.Server(addr, json.loads(options))
+    opts = json.loads(options)
+    if workers is not None:
+        opts["workers"] = workers
+    srv = mod.Server(addr, opts)
     srv.serve(MyDispatcher())
 
 
@@ -179,7 +223,7 @@ def client_ppool(mode, addr, method, num, params, options, verbose):
 def client_async(mode, addr, method, num, params, options, verbose):
     setupLog(verbose)
     mod = getattr(lotrpc, mode)
-    cl = mod.Client(addr, json.loads(options))
+    cl = new_async_client(mod, addr, json.loads(options))
     res = do_call_async(cl, num, method, json.loads(params))
     print(res)
 
@@ -192,13 +236,42 @@ def client_async(mode, addr, method, num, params, options, verbose):
 @click.option("--client-options", default="{}")
 @click.option("--server-options", default="{}")
 @click.option("--accesslog/--no-accesslog", default=False)
+@click.option("--accesslog-options", default="{}",
+              help='{"sample":0.1,"payload":"size","format":"json","file":"access.log"}')
+@click.option("--cache", default=None, help='cache policy: {"ttl":{"method":sec},"store":"sqlite","path":"..."}')
+@click.option("--balance", default="{}", help='upstreams in ADDR_C separated by ",": {"strategy":"round_robin"}')
+@click.option("--batch", default=None, help='micro-batch upstream calls: {"window_ms":2,"max_batch":64}')
+@click.option("--async", "use_async", is_flag=True, default=False,
+              help="await the upstream AsyncClient (server: json, aiojson, aioxml)")
 @click.option("--verbose/--no-verbose", default=False)
-def prox(server, addr_s, client, addr_c, client_options, server_options, verbose, accesslog):
+def prox(server, addr_s, client, addr_c, client_options, server_options, verbose, accesslog,
+         accesslog_options, cache, balance, batch, use_async):
     setupLog(verbose)
-    srv = getattr(lotrpc, server).Server(addr_s, json.loads(server_options))
-    cl = getattr(lotrpc, client).Client(addr_c, json.loads(client_options))
     if accesslog:
-        prox = lotrpc.LoggingProxy(srv, cl)
+        setupAccessLog()
+    srv = getattr(lotrpc, server).Server(addr_s, json.loads(server_options))
+    if use_async:
+        if accesslog or cache is not None or batch is not None or "," in addr_c:
+            raise click.UsageError(
+                "--async does not support --accesslog, --cache, --batch or several upstreams")
+        cl = new_async_client(getattr(lotrpc, client), addr_c, json.loads(client_options))
+        lotrpc.AsyncProxy(srv, cl).serve()
+        return
+    if "," in addr_c:
+        cl = lotrpc.BalancedClient.from_addrs(
+            getattr(lotrpc, client), addr_c, json.loads(client_options), json.loads(balance))
+    else:
+        cl = getattr(lotrpc, client).Client(addr_c, json.loads(client_options))
+    if batch is not None:
+        cl = lotrpc.BatchingClient(cl, json.loads(batch))
+    if cache is not None:
+        if accesslog:
+            prox = lotrpc.CachingLoggingProxy(srv, cl, json.loads(cache),
+                                              log_params=json.loads(accesslog_options))
+        else:
+            prox = lotrpc.CachingProxy(srv, cl, json.loads(cache))
+    elif accesslog:
+        prox = lotrpc.LoggingProxy(srv, cl, log_params=json.loads(accesslog_options))
     else:
         prox = lotrpc.Proxy(srv, cl)
     prox.serve()
@@ -211,13 +284,14 @@ def prox(server, addr_s, client, addr_c, client_options, server_options, verbose
 @click.argument('addr_c', default="http://localhost:9998/")
 @click.option("--client-options", default="{}")
 @click.option("--server-options", default="{}")
+@click.option("--auth-options", default="{}", help='{"hash_workers":2,"verify_cache_ttl":60,"login_rate":0.2}')
 @click.option("--verbose/--no-verbose", default=False)
-def proxy_auth(server, addr_s, client, addr_c, client_options, server_options, verbose):
+def proxy_auth(server, addr_s, client, addr_c, client_options, server_options, auth_options, verbose):
     from lotrpc.proxyauth import LoginProxy
     setupLog(verbose)
     srv = getattr(lotrpc, server).Server(addr_s, json.loads(server_options))
     cl = getattr(lotrpc, client).Client(addr_c, json.loads(client_options))
-    prox = LoginProxy(srv, cl)
+    prox = LoginProxy(srv, cl, json.loads(auth_options))
     prox.serve()
 
 
@@ -230,13 +304,17 @@ def qworker(q):
         q.task_done()
 
 
-def qworker2(q, loop):
-    while True:
-        item = q.get()
-        if item is None:
-            break
-        loop.run_until_complete(item)
-        q.task_done()
+async def bench_async(cl, loop, bm, method, arg, qsize):
+    pending = set()
+    for i in bm:
+        if len(pending) >= qsize:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for x in done:
+                x.result()
+        pending.add(asyncio.ensure_future(cl.asynccall(loop, method, arg)))
+    if pending:
+        for x in (await asyncio.wait(pending))[0]:
+            x.result()
 
 
 @cli.command(help="start benchmark client")
@@ -295,15 +373,177 @@ def benchmark(mode, addr, method, loop, params, options, verbose, qsize, filter)
         def asynccall(bm):
             try:
                 loop = asyncio.get_event_loop()
-                t = threading.Thread(target=qworker2, args=(q, loop))
-                t.start()
-                for i in bm:
-                    q.put(cl.asynccall(loop, method, arg))
-                q.put(None)
-                t.join()
+                acl = new_async_client(mod, addr, json.loads(options))
+                loop.run_until_complete(bench_async(acl, loop, bm, method, arg, qsize))
+                if isinstance(acl, lotrpc.AsyncClientIf):
+                    loop.run_until_complete(acl.close())
             except Exception as e:
                 raise Skip("error {}".format(e))
 
 
+class BenchDispatcher(lotrpc.SimpleDispatcher):
+    def do_hello(self, params):
+        return params
+
+
+def lookup_uncached(d, method, params):
+    # method resolution as done per request without the lookup cache
+    mtn = d.prefix + method.replace(".", "_")
+    if hasattr(d, mtn) and callable(getattr(d, mtn)):
+        return getattr(d, mtn)(params)
+    raise Exception("method not found: {}".format(mtn))
+
+
+@cli.command(help="dispatcher micro benchmark")
+@click.option("--loop", type=int, default=1000000)
+@click.option("--method", default="hello", type=str)
+@click.option("--filter", default=None)
+@click.option("--verbose/--no-verbose", default=False)
+def benchmark_dispatch(loop, method, filter, verbose):
+    setupLog(verbose)
+    d = BenchDispatcher()
+    arg = {}
+
+    with Benchmarker(loop, filter=filter) as bench:
+        @bench('direct')
+        def direct(bm):
+            fn = d.do_hello
+            for i in bm:
+                fn(arg)
+
+        @bench('uncached')
+        def uncached(bm):
+            for i in bm:
+                lookup_uncached(d, method, arg)
+
+        @bench('cached')
+        def cached(bm):
+            for i in bm:
+                d(method, arg)
+
+        @bench('not-found')
+        def notfound(bm):
+            for i in bm:
+                try:
+                    d("no.such.method", arg)
+                except Exception:
+                    pass
+
+
+def codec_payload(size):
+    # roughly `size` bytes of typical rpc data
+    item = {"id": 12345, "name": "xyzxyz", "flag": True, "value": 1.5, "tags": ["a", "b"]}
+    num = max(1, size // len(json.dumps(item)))
+    return {"jsonrpc": "2.0", "id": 0, "result": [item] * num}
+
+
+@cli.command(help="json codec benchmark (payload size sweep)")
+@click.option("--loop", type=int, default=1000)
+@click.option("--sizes", default="100,1000,10000,100000")
+@click.option("--codec", "codecs", default="json,orjson,ujson")
+@click.option("--filter", default=None)
+def benchmark_codec(loop, sizes, codecs, filter):
+    from lotrpc.json.codec import get_codec
+    with Benchmarker(loop, filter=filter) as bench:
+        for name in codecs.split(","):
+            for size in map(int, sizes.split(",")):
+                payload = codec_payload(size)
+
+                def enc(bm, name=name, payload=payload):
+                    try:
+                        encode, _ = get_codec(name)
+                    except ImportError as e:
+                        raise Skip("{}".format(e))
+                    for i in bm:
+                        encode(payload)
+
+                def dec(bm, name=name, payload=payload):
+                    try:
+                        encode, decode = get_codec(name)
+                    except ImportError as e:
+                        raise Skip("{}".format(e))
+                    data = encode(payload)
+                    for i in bm:
+                        decode(data)
+                bench("{} encode {}".format(name, size))(enc)
+                bench("{} decode {}".format(name, size))(dec)
+
+
+@cli.command(help="cross-protocol benchmark: local server per mode, payload size x concurrency")
+@click.option("--modes", default=",".join(lotrpc.bench.modes))
+@click.option("--sizes", default="100,10000", help="payload bytes")
+@click.option("--concurrency", default="1,16", help="client threads")
+@click.option("--duration", type=float, default=2, help="seconds per run")
+@click.option("--payload", type=click.Choice(["string", "struct"]), default="string")
+@click.option("--call-timeout", type=float, default=10, help="seconds, a slower call is an error")
+@click.option("--server-options", default="{}")
+@click.option("--client-options", default="{}")
+@click.option("--grpc-source", default="examples/grpc/hello.proto")
+@click.option("--output", default=None, help="write the results (JSON) here instead of stdout")
+@click.option("--compare", default=None, help="results (JSON) of an earlier run")
+@click.option("--verbose/--no-verbose", default=False)
+def benchmark_suite(modes, sizes, concurrency, duration, payload, call_timeout, server_options,
+                    client_options, grpc_source, output, compare, verbose):
+    setupLog(verbose)
+    # progress on stderr, even without --verbose
+    getLogger("lotrpc.bench").setLevel(INFO)
+    if not getLogger("lotrpc.bench").hasHandlers():
+        getLogger("lotrpc.bench").addHandler(StreamHandler())
+    suite = lotrpc.bench.Suite({
+        "modes": modes.split(","),
+        "sizes": [int(x) for x in sizes.split(",")],
+        "concurrency": [int(x) for x in concurrency.split(",")],
+        "duration": duration,
+        "payload": payload,
+        "call_timeout": call_timeout,
+        "server_options": json.loads(server_options),
+        "client_options": json.loads(client_options),
+        "grpc_source": grpc_source,
+    })
+    res = suite.run()
+    if output is not None:
+        with open(output, "w") as ofp:
+            json.dump(res, ofp, indent=2)
+    else:
+        json.dump(res, sys.stdout, indent=2)
+        print()
+    if compare is not None:
+        with open(compare) as ifp:
+            old = json.load(ifp)
+        for line in lotrpc.bench.compare(old, res):
+            print(line, file=sys.stderr)
+
+
+startup_script = """
+import sys, time
+from lotrpc.grpc.rpc import read_proto
+ts = time.perf_counter()
+read_proto(sys.argv[1], sys.argv[2])
+t1 = time.perf_counter()
+read_proto(sys.argv[1], sys.argv[2])
+print(t1 - ts, time.perf_counter() - t1)
+"""
+
+
+@cli.command(help="grpc proto load benchmark (cold/warm cache)")
+@click.option("--source", default="examples/grpc/hello.proto")
+@click.option("--loop", type=int, default=5)
+def benchmark_startup(source, loop):
+    res = {"cold": [], "warm": [], "memo": []}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_dir = os.path.join(tmpdir, "cache")
+        for i in range(loop):
+            for name in ("cold", "warm"):
+                if name == "cold":
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                out = subprocess.check_output(
+                    [sys.executable, "-c", startup_script, source, cache_dir])
+                first, memo = map(float, out.split())
+                res[name].append(first)
+                res["memo"].append(memo)
+    for k, v in res.items():
+        print("%-5s %10.3f ms" % (k, 1000 * sum(v) / len(v)))
+
+
 if __name__ == '__main__':
     cli()
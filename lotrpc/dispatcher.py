@@ -1,16 +1,99 @@
-from logging import getLogger
+import asyncio
+import inspect
+from logging import getLogger, DEBUG
 
 log = getLogger(__name__)
 
 
+class MethodNotFound(Exception):
+    # raised by dispatchers for an unknown method (json server: -32601)
+    pass
+
+
 class SimpleDispatcher:
     prefix = "do_"
+    max_cache = 1024
 
-    def __call__(self, method, params):
-        log.debug("dispatch %s %s", method, params)
+    def lookup(self, method):
+        # rpc method name -> bound callable (None if not found), cached per instance
+        methods = self.__dict__.setdefault("_methods", {})
+        try:
+            return methods[method]
+        except KeyError:
+            pass
         mtn = self.prefix + method.replace(".", "_")
-        if hasattr(self, mtn) and callable(getattr(self, mtn)):
+        fn = getattr(self, mtn, None)
+        if not callable(fn):
+            fn = None
+            log.warning("method not found: %s", mtn)
+            if len(methods) >= self.max_cache:
+                # do not let unknown names grow the table forever
+                methods.clear()
+        else:
             log.debug("found method %s", mtn)
-            return getattr(self, mtn)(params)
-        log.warning("method not found: %s", mtn)
-        raise Exception("method not found: {}".format(mtn))
+        methods[method] = fn
+        return fn
+
+    def __call__(self, method, params):
+        if log.isEnabledFor(DEBUG):
+            log.debug("dispatch %s %s", method, params)
+        try:
+            fn = self._methods[method]
+        except (AttributeError, KeyError):
+            fn = self.lookup(method)
+        if fn is None:
+            raise MethodNotFound("method not found: {}{}".format(
+                self.prefix, method.replace(".", "_")))
+        return fn(params)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_methods", None)
+        return state
+
+
+def is_async(d, method):
+    # True if d(method, params) returns a coroutine: await it instead of using a thread
+    if isinstance(d, SimpleDispatcher):
+        return inspect.iscoroutinefunction(d.lookup(method))
+    if hasattr(d, "is_async"):
+        # wrappers (metrics) answer for what they wrap
+        return d.is_async(method)
+    return inspect.iscoroutinefunction(d) or \
+        inspect.iscoroutinefunction(getattr(d, "__call__", None))
+
+
+async def _wait(res):
+    return await res
+
+
+def call_sync(d, method, params):
+    # for servers without an event loop: run coroutine handlers to completion
+    res = d(method, params)
+    if inspect.isawaitable(res):
+        # not asyncio.run: python 3.6
+        loop = asyncio.new_event_loop()
+        try:
+            res = loop.run_until_complete(_wait(res))
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+    return res
+
+
+def iter_sync(res):
+    # for servers without an event loop: iterate sync or async generators
+    if not hasattr(res, "__aiter__"):
+        yield from res
+        return
+    loop = asyncio.new_event_loop()
+    it = res.__aiter__()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(it.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
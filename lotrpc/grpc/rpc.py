@@ -2,20 +2,27 @@
 import os
 import sys
 import shutil
+import hashlib
 import tempfile
 import importlib
+import threading
 import time
 import functools
 import concurrent.futures
 from logging import getLogger
 
+import google.protobuf
+from google.protobuf import descriptor_pool, message_factory
 from google.protobuf.json_format import MessageToDict, ParseDict
 from google.protobuf.descriptor_pb2 import FileDescriptorSet
 import grpc_tools.protoc
+from grpc_tools.grpc_version import VERSION as grpc_tools_version
 import grpc
+import grpc.aio
 
 from ..server import ServerIf
-from ..client import ClientIf
+from ..client import ClientIf, AsyncClientIf
+from ..dispatcher import call_sync, iter_sync
 
 log = getLogger(__name__)
 
@@ -27,25 +34,62 @@ def read_desc(src):
 
 def compile(src, dest):
     shutil.copyfile(src, os.path.join(dest, os.path.basename(src)))
-    orgdir = os.getcwd()
-    os.chdir(dest)
     bn = os.path.splitext(os.path.basename(src))[0]
-    dsname = bn + ".pb"
+    dsname = os.path.join(dest, bn + ".pb")
     options = {
-        "proto_path": ".",
-        "python_out": ".",
-        "grpc_python_out": ".",
+        "proto_path": dest,
+        "python_out": dest,
+        "grpc_python_out": dest,
         "descriptor_set_out": dsname,
     }
-    arg = ["--%s=%s" % (x[0], x[1]) for x in options.items()]
-    arg.append(os.path.basename(src))
-    log.debug("pre-listdir %s", os.listdir(dest))
+    # argv[0] is the program name
+    arg = ["grpc_tools.protoc"] + ["--%s=%s" % (x[0], x[1]) for x in options.items()]
+    # well-known types (google/protobuf/*.proto)
+    arg.append("--proto_path=%s" % os.path.join(os.path.dirname(grpc_tools.protoc.__file__), "_proto"))
+    arg.append(os.path.join(dest, os.path.basename(src)))
     log.debug("compile %s", arg)
     rst = grpc_tools.protoc.main(arg)
     log.debug("compile result: %s", rst)
-    ret = read_desc(dsname)
-    os.chdir(orgdir)
-    return ret
+    if rst != 0:
+        raise Exception("protoc failed: {} ({})".format(src, rst))
+    return read_desc(dsname)
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "lotrpc", "grpc")
+
+
+def proto_key(src):
+    # generated code depends on the source and on the code generator
+    h = hashlib.sha256()
+    for x in (grpc_tools_version, google.protobuf.__version__, os.path.basename(src)):
+        h.update(x.encode("utf-8") + b"\0")
+    with open(src, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def compile_cached(src, key, cache_dir):
+    dest = os.path.join(cache_dir, key)
+    if os.path.isdir(dest):
+        log.debug("use cache %s", dest)
+        return dest
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+    try:
+        compile(src, tmp)
+        # atomic publish: concurrent workers either see all files or none
+        os.rename(tmp, dest)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(dest):
+            raise
+        log.debug("lost race for %s", dest)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return dest
 
 
 def desc2typemap(desc):
@@ -60,6 +104,10 @@ def desc2typemap(desc):
                 typemap[svname + "." + name] = {
                     "arg": ityp.split(".")[-1],
                     "return": otyp.split(".")[-1],
+                    "arg_full": ityp.lstrip("."),
+                    "return_full": otyp.lstrip("."),
+                    "client_streaming": m.client_streaming,
+                    "server_streaming": m.server_streaming,
                 }
     log.debug("typemap %s", typemap)
     return typemap
@@ -70,7 +118,8 @@ def do_import(src, dest):
     modname = bn + "_pb2"
     modname = modname.replace("/", ".")
     log.debug("listdir %s", os.listdir(dest))
-    sys.path.append(dest)
+    if dest not in sys.path:
+        sys.path.append(dest)
     log.debug("module load from %s %s", dest, modname)
     mod = importlib.import_module(modname)
     grpcmod = importlib.import_module(modname + "_grpc")
@@ -78,56 +127,197 @@ def do_import(src, dest):
     return mod, grpcmod
 
 
-def read_proto(src):
-    tmpdir = tempfile.TemporaryDirectory()
-    log.debug("tmpdir %s", tmpdir.name)
-    desc = compile(src, tmpdir.name)
-    typemap = desc2typemap(desc)
-    mod, grpcmod = do_import(src, tmpdir.name)
-    log.debug("moddir %s", dir(mod))
-    log.debug("grpcmoddir %s", dir(grpcmod))
-    for k, v in typemap.items():
-        if hasattr(mod, v.get("arg")):
-            typemap[k]["argtype"] = getattr(mod, v.get("arg"))
-        if hasattr(mod, v.get("return")):
-            typemap[k]["rettype"] = getattr(mod, v.get("return"))
-    return desc, typemap, mod, grpcmod
+def message_class(mod, name, fullname):
+    if hasattr(mod, name):
+        return getattr(mod, name)
+    # imported type, e.g. google.protobuf.Timestamp
+    try:
+        desc = descriptor_pool.Default().FindMessageTypeByName(fullname)
+        return message_factory.GetMessageClass(desc)
+    except Exception as e:
+        log.debug("message class %s not found: %s", fullname, e)
+        return None
+
+
+# proto key -> (desc, typemap, mod, grpcmod), shared by all clients/servers
+proto_memo = {}
+proto_lock = threading.Lock()
+
+
+def read_proto(src, cache_dir=None):
+    key = proto_key(src)
+    with proto_lock:
+        if key in proto_memo:
+            return proto_memo[key]
+        dest = compile_cached(src, key, cache_dir or default_cache_dir())
+        bn = os.path.splitext(os.path.basename(src))[0]
+        desc = read_desc(os.path.join(dest, bn + ".pb"))
+        typemap = desc2typemap(desc)
+        mod, grpcmod = do_import(src, dest)
+        log.debug("moddir %s", dir(mod))
+        log.debug("grpcmoddir %s", dir(grpcmod))
+        for k, v in typemap.items():
+            typemap[k]["grpcmod"] = grpcmod
+            typemap[k]["argtype"] = message_class(mod, v.get("arg"), v.get("arg_full"))
+            typemap[k]["rettype"] = message_class(mod, v.get("return"), v.get("return_full"))
+        proto_memo[key] = (desc, typemap, mod, grpcmod)
+        return proto_memo[key]
+
+
+def read_protos(src, cache_dir=None):
+    # src: a .proto path or a list of them -> typemap of all their services
+    if isinstance(src, str):
+        src = [src]
+    typemap = {}
+    for s in src:
+        tm = read_proto(s, cache_dir)[1]
+        for k in tm:
+            if k in typemap:
+                raise Exception("duplicate method {} in {}".format(k, s))
+        typemap.update(tm)
+    return typemap
+
+
+def is_repeated(fd):
+    if hasattr(fd, "is_repeated"):
+        return fd.is_repeated
+    return fd.label == fd.LABEL_REPEATED
+
+
+def msg2dict(msg):
+    # binary mode: proto field names and native values, bytes stay bytes
+    # (MessageToDict would base64 them)
+    res = {}
+    for fd, v in msg.ListFields():
+        if fd.message_type is not None:
+            if fd.message_type.GetOptions().map_entry:
+                if fd.message_type.fields_by_name["value"].message_type is not None:
+                    v = {k: msg2dict(x) for k, x in v.items()}
+                else:
+                    v = dict(v)
+            elif is_repeated(fd):
+                v = [msg2dict(x) for x in v]
+            else:
+                v = msg2dict(v)
+        elif is_repeated(fd):
+            v = list(v)
+        res[fd.name] = v
+    return res
+
+
+def to_bytes(v):
+    # protobuf only takes bytes: bytearray/memoryview cost one copy here
+    return v if isinstance(v, bytes) else bytes(v)
+
+
+def dict2msg(d, msg):
+    # binary mode counterpart of ParseDict
+    fields = msg.DESCRIPTOR.fields_by_name
+    for k, v in d.items():
+        fd = fields.get(k)
+        if fd is None:
+            raise Exception("no such field {} in {}".format(k, msg.DESCRIPTOR.full_name))
+        if fd.message_type is not None:
+            field = getattr(msg, k)
+            if fd.message_type.GetOptions().map_entry:
+                vfd = fd.message_type.fields_by_name["value"]
+                for kk, vv in v.items():
+                    if vfd.message_type is not None:
+                        dict2msg(vv, field[kk])
+                    elif vfd.type == vfd.TYPE_BYTES:
+                        field[kk] = to_bytes(vv)
+                    else:
+                        field[kk] = vv
+            elif is_repeated(fd):
+                for x in v:
+                    dict2msg(x, field.add())
+            else:
+                dict2msg(v, field)
+        elif fd.type == fd.TYPE_BYTES:
+            if is_repeated(fd):
+                getattr(msg, k).extend(to_bytes(x) for x in v)
+            else:
+                setattr(msg, k, to_bytes(v))
+        elif is_repeated(fd):
+            getattr(msg, k).extend(v)
+        else:
+            setattr(msg, k, v)
+    return msg
+
+
+def codec(binary=False):
+    # (message -> dict, (dict, message) -> message)
+    if binary:
+        return msg2dict, dict2msg
+    return MessageToDict, ParseDict
 
 
 class Server(ServerIf):
     def __init__(self, addr: str, params: dict = {}):
         super().__init__(addr, params)
+        self.typemap = {}
         src = self.params.get("source", None)
         if src is not None:
-            self.desc, self.typemap, self.mod, self.grpcmod = read_proto(src)
+            self.typemap = read_protos(src, self.params.get("cache_dir", None))
             log.debug("typemap %s", self.typemap)
+        self.to_dict, self.from_dict = codec(self.params.get("binary", False))
 
-    def mtd(yourself, myself, method, typeinfo, req, context):
-        log.debug("method called you=%s, me=%s, method=%s, typeinfo=%s, req=%s, ctxt=%s",
-                  yourself, myself, method, typeinfo, req, context)
-        res = yourself.d(method, MessageToDict(req))
+    def mtd(self, method, typeinfo, req, context):
+        log.debug("method called method=%s, typeinfo=%s, req=%s, ctxt=%s",
+                  method, typeinfo, req, context)
+        if self.executor is not None:
+            res = self.submit(method, self.to_dict(req)).result()
+        else:
+            res = call_sync(self.d, method, self.to_dict(req))
         restype = typeinfo.get("rettype")
-        ret = ParseDict(res, restype())
+        ret = self.from_dict(res, restype())
         return ret
 
+    def mtd_stream(self, method, typeinfo, req, context):
+        # streaming methods run in the grpc thread: the dispatcher gets an
+        # iterator of dicts (client streaming) and may return a sync or async
+        # iterator of dicts (server streaming)
+        log.debug("stream method called method=%s, typeinfo=%s", method, typeinfo)
+        if typeinfo.get("client_streaming"):
+            arg = (self.to_dict(x) for x in req)
+        else:
+            arg = self.to_dict(req)
+        res = call_sync(self.d, method, arg)
+        restype = typeinfo.get("rettype")
+        if typeinfo.get("server_streaming"):
+            return (self.from_dict(x, restype()) for x in iter_sync(res))
+        return self.from_dict(res, restype())
+
     def serve(self, dispatcher):
+        dispatcher = self.wrap_dispatcher(dispatcher)
         self.d = dispatcher
-        bn = list(set([x.split(".", 1)[0] for x in self.typemap.keys()]))[0]
-        servicer = getattr(self.grpcmod, bn + "Servicer")
-        funcs = {
-            "d": dispatcher,
-        }
+        services = {}
         for k, v in self.typemap.items():
-            fname = k.split(".", 1)[-1]
-            log.debug("func: %s %s %s", fname, k, v)
-            funcs[fname] = functools.partialmethod(self.mtd, k, v)
-        log.debug("servicer: %s funcs=%s", bn, funcs)
-        myservicer = type(bn + "Servicer", (servicer,), funcs)
-        server = grpc.server(
-            concurrent.futures.ThreadPoolExecutor(max_workers=10))
-        addfn = getattr(self.grpcmod, "add_" + bn + "Servicer_to_server")
-        log.debug("addfn: %s", addfn)
-        addfn(myservicer(), server)
+            services.setdefault(k.split(".", 1)[0], {})[k] = v
+        if self.params.get("executor", "thread") != "thread":
+            # grpc handles requests in its own threads, dispatch in the pool
+            self.start_executor(dispatcher)
+        server = grpc.server(concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.params.get("max_workers", 10)))
+        for bn, methods in services.items():
+            grpcmod = next(iter(methods.values()))["grpcmod"]
+            servicer = getattr(grpcmod, bn + "Servicer")
+            funcs = {
+                "d": dispatcher,
+            }
+            for k, v in methods.items():
+                fname = k.split(".", 1)[-1]
+                log.debug("func: %s %s %s", fname, k, v)
+                # partial objects are not bound to the servicer instance
+                if v.get("client_streaming") or v.get("server_streaming"):
+                    funcs[fname] = functools.partial(self.mtd_stream, k, v)
+                else:
+                    funcs[fname] = functools.partial(self.mtd, k, v)
+            log.debug("servicer: %s funcs=%s", bn, funcs)
+            myservicer = type(bn + "Servicer", (servicer,), funcs)
+            addfn = getattr(grpcmod, "add_" + bn + "Servicer_to_server")
+            log.debug("addfn: %s", addfn)
+            addfn(myservicer(), server)
         server.add_insecure_port("%s:%s" % (
             self.addr_parsed.hostname, self.addr_parsed.port))
         log.debug("start server %s", server)
@@ -139,29 +329,132 @@ class Server(ServerIf):
             server.stop(0)
 
 
+def build_methods(typemap, channel):
+    # "Service.Method" -> (stub method, request class, streaming), one stub per service.
+    # streaming is None for unary methods, else (client_streaming, server_streaming)
+    stubs = {}
+    methods = {}
+    for k, v in typemap.items():
+        if v.get("argtype") is None or v.get("rettype") is None:
+            continue
+        svname, funcname = k.split(".", 1)
+        if svname not in stubs:
+            stubs[svname] = getattr(v["grpcmod"], svname + "Stub")(channel)
+        stream = None
+        if v.get("client_streaming") or v.get("server_streaming"):
+            stream = (v.get("client_streaming"), v.get("server_streaming"))
+        methods[k] = (getattr(stubs[svname], funcname), v["argtype"], stream)
+    log.debug("methods %s", methods)
+    return methods
+
+
+def to_message(params, argtype, message=False, from_dict=ParseDict):
+    if message and isinstance(params, argtype):
+        return params
+    return from_dict(params, argtype())
+
+
 class Client(ClientIf):
+    # params: message=True to pass and return protobuf messages instead of dicts,
+    # binary=True for dicts keyed by proto field name with bytes left as bytes
     def __init__(self, addr: str, params: dict = {}):
         super().__init__(addr, params)
+        self.typemap = {}
         src = self.params.get("source", None)
         if src is not None:
-            self.desc, self.typemap, self.mod, self.grpcmod = read_proto(src)
+            self.typemap = read_protos(src, self.params.get("cache_dir", None))
             log.debug("typemap %s", self.typemap)
+        self.message = self.params.get("message", False)
+        self.to_dict, self.from_dict = codec(self.params.get("binary", False))
         self.channel = grpc.insecure_channel("%s:%s" % (
             self.addr_parsed.hostname, self.addr_parsed.port))
+        self.methods = build_methods(self.typemap, self.channel)
 
     def call(self, method: str, params=None):
-        sig = self.typemap.get(method, {})
-        log.debug("call %s %s sig=%s", method, params, sig)
-        argtype = sig.get("argtype", None)
-        restype = sig.get("rettype", None)
-        if argtype is None or restype is None:
+        # client streaming: params is an iterable of dicts (messages).
+        # server streaming: returns a generator yielding dicts (messages) as they arrive
+        try:
+            mtd, argtype, stream = self.methods[method]
+        except KeyError:
             raise Exception("no such method? %s" % (method))
-        arg = ParseDict(params, argtype())
-        svname, funcname = method.split(".", 1)
-        log.debug("service=%s, func=%s", svname, funcname)
-        stubcls = getattr(self.grpcmod, svname + "Stub")
-        stub = stubcls(self.channel)
-        mtd = getattr(stub, funcname)
-        log.debug("method %s %s %s arg=%s", mtd, stub, funcname, arg)
+        if stream is not None:
+            return self.call_stream(mtd, argtype, stream, params)
+        if self.message:
+            if not isinstance(params, argtype):
+                params = self.from_dict(params, argtype())
+            return mtd(params)
+        return self.to_dict(mtd(self.from_dict(params, argtype())))
+
+    def call_stream(self, mtd, argtype, stream, params):
+        client_streaming, server_streaming = stream
+        if client_streaming:
+            arg = (to_message(x, argtype, self.message, self.from_dict) for x in params)
+        else:
+            arg = to_message(params, argtype, self.message, self.from_dict)
         rsp = mtd(arg)
-        return MessageToDict(rsp)
+        if self.message:
+            return rsp
+        if server_streaming:
+            return (self.to_dict(x) for x in rsp)
+        return self.to_dict(rsp)
+
+
+class AsyncClient(AsyncClientIf):
+    def __init__(self, addr: str, params: dict = {}):
+        super().__init__(addr, params)
+        self.typemap = {}
+        src = self.params.get("source", None)
+        if src is not None:
+            self.typemap = read_protos(src, self.params.get("cache_dir", None))
+            log.debug("typemap %s", self.typemap)
+        self.message = self.params.get("message", False)
+        self.to_dict, self.from_dict = codec(self.params.get("binary", False))
+        self.channel = None
+        self.methods = {}
+
+    async def call(self, method: str, params=None):
+        # server streaming: returns an async generator yielding dicts (messages)
+        if self.channel is None:
+            # grpc.aio channels are bound to the running loop
+            self.channel = grpc.aio.insecure_channel("%s:%s" % (
+                self.addr_parsed.hostname, self.addr_parsed.port))
+            self.methods = build_methods(self.typemap, self.channel)
+        try:
+            mtd, argtype, stream = self.methods[method]
+        except KeyError:
+            raise Exception("no such method? %s" % (method))
+        if stream is not None:
+            return await self.call_stream(mtd, argtype, stream, params)
+        if self.message:
+            if not isinstance(params, argtype):
+                params = self.from_dict(params, argtype())
+            return await mtd(params)
+        return self.to_dict(await mtd(self.from_dict(params, argtype())))
+
+    async def stream_response(self, rsp):
+        async for x in rsp:
+            yield self.to_dict(x)
+
+    async def call_stream(self, mtd, argtype, stream, params):
+        client_streaming, server_streaming = stream
+        if client_streaming:
+            if hasattr(params, "__aiter__"):
+                arg = self.aiter_message(params, argtype)
+            else:
+                arg = (to_message(x, argtype, self.message, self.from_dict) for x in params)
+        else:
+            arg = to_message(params, argtype, self.message, self.from_dict)
+        rsp = mtd(arg)
+        if server_streaming:
+            return rsp if self.message else self.stream_response(rsp)
+        rsp = await rsp
+        return rsp if self.message else self.to_dict(rsp)
+
+    async def aiter_message(self, params, argtype):
+        async for x in params:
+            yield to_message(x, argtype, self.message, self.from_dict)
+
+    async def close(self):
+        if self.channel is not None:
+            await self.channel.close()
+            self.channel = None
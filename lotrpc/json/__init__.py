@@ -1 +1,2 @@
-from .rpc import Client, Server
+from .rpc import Client, Server, AsyncClient
+from .codec import get_codec
@@ -0,0 +1,44 @@
+# JSON codecs: encode(obj) -> bytes, decode(bytes) -> obj
+import json
+import importlib
+from logging import getLogger
+
+log = getLogger(__name__)
+
+
+def std_encode(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def std_codec():
+    return std_encode, json.loads
+
+
+def orjson_codec():
+    orjson = importlib.import_module("orjson")
+    return orjson.dumps, orjson.loads
+
+
+def ujson_codec():
+    ujson = importlib.import_module("ujson")
+
+    def encode(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return encode, ujson.loads
+
+
+codecs = {
+    "json": std_codec,
+    "stdlib": std_codec,
+    "orjson": orjson_codec,
+    "ujson": ujson_codec,
+}
+
+
+def get_codec(name=None):
+    # name: json (default), orjson, ujson. orjson/ujson are optional
+    if name is None:
+        name = "json"
+    if name not in codecs:
+        raise Exception("unknown codec: {}".format(name))
+    return codecs[name]()
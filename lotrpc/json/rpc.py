@@ -1,56 +1,120 @@
 # JSON-RPC Server/Client
 from ..server import ServerIf
-from ..client import ClientIf
-import json
+from ..client import ClientIf, AsyncClientIf
+from ..dispatcher import is_async, MethodNotFound
+from .codec import get_codec
+import time
+import asyncio
+import threading
 import requests
+import requests.adapters
+import aiohttp
 from logging import getLogger
 import tornado.web
-from tornado.gen import coroutine as tasync
-# from tornado.web import asynchronous as tasync
+import tornado.httpserver
 from tornado.ioloop import IOLoop
-from concurrent.futures import ThreadPoolExecutor
-from tornado.platform.asyncio import to_tornado_future
 
 log = getLogger(__name__)
 
 
 class Server(ServerIf):
     class Handler(tornado.web.RequestHandler):
-        executor = ThreadPoolExecutor()
-
-        def initialize(self, d):
+        def initialize(self, d, srv):
             log.debug("initialize %s", d)
             self.d = d
+            self.srv = srv
+            self.encode = srv.encode
+            self.decode = srv.decode
 
         def set_default_headers(self):
             self.set_header("content-type", "application/json")
 
         async def bgtask(self, method, params):
-            ft = Server.Handler.executor.submit(self.d, method, params)
-            result = await to_tornado_future(ft)
+            if is_async(self.d, method):
+                if tornado.version_info < (5, ):
+                    # tornado 4 runs handlers outside asyncio tasks, and aiohttp
+                    # (AsyncClient timeouts) needs one
+                    return await asyncio.ensure_future(self.d(method, params))
+                return await self.d(method, params)
+            ft = self.srv.submit(method, params)
+            result = await asyncio.wrap_future(ft)
             return result
 
-        @tasync
-        def post(self):
-            payload = json.loads(self.request.body)
-            log.debug("got request %s", payload)
+        async def process(self, payload):
+            if not isinstance(payload, dict):
+                return {"jsonrpc": "2.0", "id": None,
+                        "error": {"code": -32600, "message": "Invalid Request"}}
             method = payload.get("method")
             params = payload.get("params", {})
-            result = yield from self.bgtask(method, params)
-            resp = {
+            try:
+                result = await self.bgtask(method, params)
+            except Exception as e:
+                log.debug("error %s %s", method, e)
+                code = -32601 if isinstance(e, MethodNotFound) else -32603
+                return {"jsonrpc": "2.0", "id": payload.get("id"),
+                        "error": {"code": code, "message": str(e)}}
+            return {
+                "jsonrpc": "2.0",
                 "result": result,
                 "id": payload.get("id"),
             }
-            json.dump(resp, self, ensure_ascii=False)
 
+        async def post(self):
+            sample = self.srv.profile_sample()
+            try:
+                payload = self.decode(self.request.body)
+            except ValueError as e:
+                log.debug("parse error %s", e)
+                self.write(self.encode({"jsonrpc": "2.0", "id": None,
+                                        "error": {"code": -32700, "message": "Parse error"}}))
+                return
+            log.debug("got request %s", payload)
+            if sample is not None:
+                sample.mark("decode")
+            if isinstance(payload, list) and len(payload) != 0:
+                # batch: run all entries at once, reply in request order
+                resp = await asyncio.gather(*[self.process(x) for x in payload])
+                resp = [x for x, req in zip(resp, payload)
+                        if not isinstance(req, dict) or "id" in req]
+                if len(resp) == 0:
+                    # all notifications
+                    self.set_status(204)
+                    return
+            else:
+                resp = await self.process(payload)
+            if sample is None:
+                # encode once, one write
+                self.write(self.encode(resp))
+                return
+            sample.mark("dispatch")
+            body = self.encode(resp)
+            sample.mark("encode")
+            sample.done(payload.get("method") if isinstance(payload, dict) else "_batch")
+            self.write(body)
+
+    # params: codec=json (default), orjson or ujson
     def __init__(self, addr: str, params: dict = {}):
         super().__init__(addr, params)
         self.baseurl = self.addr_parsed.path
+        self.encode, self.decode = get_codec(self.params.get("codec"))
 
     def serve(self, fn):
+        fn = self.wrap_dispatcher(fn)
+        if self.prefork(fn):
+            return
+        self.start_executor(fn)
+        if tornado.version_info < (5, ) and not IOLoop.initialized():
+            # tornado 4 has its own loop: run it on asyncio, handlers await
+            # asyncio futures (executor, batch gather, async clients)
+            from tornado.platform.asyncio import AsyncIOMainLoop
+            AsyncIOMainLoop().install()
         app = tornado.web.Application(
-            handlers=[(self.baseurl, self.Handler, {"d": fn}), ])
-        app.listen(self.addr_parsed.port)
+            handlers=[(self.baseurl, self.Handler, {"d": fn, "srv": self}), ])
+        if self.sock is not None:
+            self.sock.setblocking(False)
+            tornado.httpserver.HTTPServer(app).add_sockets([self.sock])
+        else:
+            app.listen(self.addr_parsed.port)
         try:
             IOLoop.current().start()
         except RuntimeError as e:
@@ -58,11 +122,72 @@ class Server(ServerIf):
             # raise e
 
 
+def batch_request(calls):
+    return [{
+        "method": method,
+        "params": params,
+        "jsonrpc": "2.0",
+        "id": i,
+    } for i, (method, params) in enumerate(calls)]
+
+
+def call_result(resp):
+    if "error" in resp:
+        raise Exception(resp["error"].get("message"))
+    return resp.get("result")
+
+
+def batch_result(resp, num):
+    if isinstance(resp, dict):
+        # server rejected the whole batch
+        raise Exception(resp.get("error", {}).get("message", "invalid response"))
+    res = [None] * num
+    for r in resp:
+        idx = r.get("id")
+        if not isinstance(idx, int) or not 0 <= idx < num:
+            continue
+        if "error" in r:
+            res[idx] = Exception(r["error"].get("message"))
+        else:
+            res[idx] = r.get("result")
+    return res
+
+
 class Client(ClientIf):
     hdrs = {
         "content-type": "application/json",
     }
 
+    def __init__(self, addr: str, params: dict = {}):
+        super().__init__(addr, params)
+        self.pool_size = self.params.get("pool_size", 10)
+        self.keepalive = self.params.get("keepalive", 60)
+        self.timeout = self.params.get("timeout", None)
+        self.encode, self.decode = get_codec(self.params.get("codec"))
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        self.session = requests.Session()
+        self.session.headers.update(self.hdrs)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def get_session(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.keepalive is not None and now - self.last_used > self.keepalive:
+                # idle connections may already be closed by the server
+                log.debug("keepalive expired, drop idle connections")
+                self.adapter.close()
+            self.last_used = now
+        return self.session
+
+    def post(self, payload):
+        log.debug("send request %s", payload)
+        return self.decode(self.get_session().post(
+            self.addr, data=self.encode(payload), timeout=self.timeout).content)
+
     def call(self, method, params=None):
         payload = {
             "method": method,
@@ -70,5 +195,71 @@ class Client(ClientIf):
             "jsonrpc": "2.0",
             "id": 0,
         }
+        return call_result(self.post(payload))
+
+    def call_batch(self, calls):
+        # calls: [(method, params), ...] -> results in the same order.
+        # failed entries are returned as Exception instances
+        payload = batch_request(calls)
+        if len(payload) == 0:
+            return []
+        return batch_result(self.post(payload), len(payload))
+
+    def close(self):
+        self.session.close()
+
+    def __getstate__(self):
+        # sessions (sockets, locks) cannot be pickled: rebuild them in the child
+        return {"addr": self.addr, "params": self.params}
+
+    def __setstate__(self, state):
+        self.__init__(state["addr"], state["params"])
+
+
+class AsyncClient(AsyncClientIf):
+    hdrs = Client.hdrs
+
+    def __init__(self, addr: str, params: dict = {}):
+        super().__init__(addr, params)
+        self.pool_size = self.params.get("pool_size", 100)
+        self.keepalive = self.params.get("keepalive", 60)
+        self.timeout = self.params.get("timeout", None)
+        self.encode, self.decode = get_codec(self.params.get("codec"))
+        self.session = None
+
+    def get_session(self):
+        # aiohttp sessions are bound to the running loop: create on first call
+        if self.session is None:
+            opts = {}
+            if self.keepalive is not None:
+                opts["keepalive_timeout"] = self.keepalive
+            conn = aiohttp.TCPConnector(limit=self.pool_size, **opts)
+            self.session = aiohttp.ClientSession(
+                connector=conn, headers=self.hdrs,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def post(self, payload):
         log.debug("send request %s", payload)
-        return requests.post(self.addr, data=json.dumps(payload), headers=self.hdrs).json().get("result")
+        async with self.get_session().post(self.addr, data=self.encode(payload)) as resp:
+            return self.decode(await resp.read())
+
+    async def call(self, method, params=None):
+        payload = {
+            "method": method,
+            "params": params,
+            "jsonrpc": "2.0",
+            "id": 0,
+        }
+        return call_result(await self.post(payload))
+
+    async def call_batch(self, calls):
+        payload = batch_request(calls)
+        if len(payload) == 0:
+            return []
+        return batch_result(await self.post(payload), len(payload))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
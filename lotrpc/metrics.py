@@ -0,0 +1,267 @@
+import time
+import threading
+import http.server
+import socketserver
+from concurrent.futures import Future
+from logging import getLogger
+from .client import ClientIf
+from .dispatcher import is_async
+
+log = getLogger(__name__)
+
+__all__ = ["Histogram", "Metrics", "MetricsDispatcher", "MetricsClient", "serve_metrics",
+           "metrics_method"]
+
+# python 3.6: no time.perf_counter_ns, no http.server.ThreadingHTTPServer
+perf_counter_ns = getattr(time, "perf_counter_ns", lambda: int(time.perf_counter() * 1e9))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+metrics_method = "_lotrpc.metrics"
+
+
+class Histogram:
+    # HdrHistogram-like log-linear buckets over nanoseconds: values below 2 * 2**sub_bits
+    # are exact, above that each power of two has 2**sub_bits buckets (~6% error)
+    sub_bits = 4
+
+    def __init__(self):
+        self.sub = 1 << self.sub_bits
+        self.counts = [0] * ((65 - self.sub_bits) * self.sub)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def index(self, v):
+        shift = v.bit_length() - self.sub_bits - 1
+        if shift <= 0:
+            return v
+        return (shift + 1) * self.sub + (v >> shift) - self.sub
+
+    def value(self, idx):
+        # middle of the bucket
+        shift = idx // self.sub - 1
+        if shift <= 0:
+            return idx
+        low = (idx % self.sub + self.sub) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, v):
+        # index() inlined: this runs for every call
+        shift = v.bit_length() - self.sub_bits - 1
+        if shift <= 0:
+            self.counts[v] += 1
+        else:
+            self.counts[(shift + 1) * self.sub + (v >> shift) - self.sub] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0
+        target = q * self.count
+        n = 0
+        for idx, c in enumerate(self.counts):
+            n += c
+            if c and n >= target:
+                return min(self.value(idx), self.max)
+        return self.max
+
+
+class MethodStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.inflight = 0
+        self.hist = Histogram()
+
+
+class Metrics:
+    # per (kind, method): calls, errors, in-flight and latency histogram.
+    # kind: server, client, upstream (proxy)
+    quantiles = (0.5, 0.9, 0.99, 0.999)
+    max_methods = 1000      # further method names are counted as "_other"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def start(self, kind, method):
+        st = self.methods.get((kind, method))
+        with self.lock:
+            if st is None:
+                if len(self.methods) >= self.max_methods:
+                    method = "_other"
+                st = self.methods.setdefault((kind, method), MethodStats())
+            st.inflight += 1
+        return st, perf_counter_ns()
+
+    def end(self, token, error=False):
+        st, ts = token
+        elapsed = perf_counter_ns() - ts
+        with self.lock:
+            st.inflight -= 1
+            st.calls += 1
+            if error:
+                st.errors += 1
+            st.hist.record(elapsed)
+
+    def snapshot(self):
+        # {(kind, method): {...}} with latencies in seconds
+        res = {}
+        with self.lock:
+            for k, st in self.methods.items():
+                res[k] = {
+                    "calls": st.calls, "errors": st.errors, "inflight": st.inflight,
+                    "sum": st.hist.sum / 1e9, "max": st.hist.max / 1e9,
+                    "quantiles": {q: st.hist.percentile(q) / 1e9 for q in self.quantiles},
+                }
+        return res
+
+    def prometheus(self):
+        snap = sorted(self.snapshot().items())
+        out = []
+
+        def lbl(kind, method, extra=""):
+            return '{kind="%s",method="%s"%s}' % (escape(kind), escape(method), extra)
+        for name, key, typ, desc in (
+                ("lotrpc_requests_total", "calls", "counter", "calls"),
+                ("lotrpc_errors_total", "errors", "counter", "failed calls"),
+                ("lotrpc_inflight", "inflight", "gauge", "calls in progress")):
+            out.append("# HELP %s %s" % (name, desc))
+            out.append("# TYPE %s %s" % (name, typ))
+            for (kind, method), v in snap:
+                out.append("%s%s %d" % (name, lbl(kind, method), v[key]))
+        name = "lotrpc_latency_seconds"
+        out.append("# HELP %s call latency" % name)
+        out.append("# TYPE %s summary" % name)
+        for (kind, method), v in snap:
+            for q, x in v["quantiles"].items():
+                out.append("%s%s %.9f" % (name, lbl(kind, method, ',quantile="%s"' % q), x))
+            out.append("%s_sum%s %.9f" % (name, lbl(kind, method), v["sum"]))
+            out.append("%s_count%s %d" % (name, lbl(kind, method), v["calls"]))
+        return "\n".join(out) + "\n"
+
+
+def escape(s):
+    return str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# process-wide registry used by servers, clients and proxies
+registry = Metrics()
+
+
+class MetricsDispatcher:
+    # wraps a dispatcher; answers _lotrpc.metrics with the Prometheus text
+    def __init__(self, d, kind="server", metrics=None):
+        self.d = d
+        self.kind = kind
+        self.metrics = metrics or registry
+
+    def is_async(self, method):
+        return method != metrics_method and is_async(self.d, method)
+
+    def __call__(self, method, params):
+        if method == metrics_method:
+            return self.metrics.prometheus()
+        token = self.metrics.start(self.kind, method)
+        try:
+            res = self.d(method, params)
+        except Exception:
+            self.metrics.end(token, True)
+            raise
+        if hasattr(res, "__await__"):
+            return self.wait(token, res)
+        self.metrics.end(token)
+        return res
+
+    async def wait(self, token, res):
+        try:
+            res = await res
+        except Exception:
+            self.metrics.end(token, True)
+            raise
+        self.metrics.end(token)
+        return res
+
+    def submit(self, executor, fn, method, params):
+        # process pool: the workers run the bare dispatcher, measure here
+        if method == metrics_method:
+            ft = Future()
+            ft.set_result(self.metrics.prometheus())
+            return ft
+        token = self.metrics.start(self.kind, method)
+        if hasattr(self.d, "submit"):
+            ft = self.d.submit(executor, fn, method, params)
+        else:
+            ft = executor.submit(fn, method, params)
+        ft.add_done_callback(lambda x: self.metrics.end(token, x.exception() is not None))
+        return ft
+
+
+class MetricsClient(ClientIf):
+    # wraps any client (sync or AsyncClientIf)
+    def __init__(self, client, kind="client", metrics=None):
+        super().__init__(client.addr, client.params)
+        self.client = client
+        self.kind = kind
+        self.metrics = metrics or registry
+
+    def call(self, method: str, params=None):
+        token = self.metrics.start(self.kind, method)
+        try:
+            res = self.client.call(method, params)
+        except Exception:
+            self.metrics.end(token, True)
+            raise
+        if hasattr(res, "__await__"):
+            return self.wait(token, res)
+        self.metrics.end(token)
+        return res
+
+    def asynccall(self, loop, method: str, params=None):
+        token = self.metrics.start(self.kind, method)
+        return self.wait(token, self.client.asynccall(loop, method, params))
+
+    async def wait(self, token, res):
+        try:
+            res = await res
+        except Exception:
+            self.metrics.end(token, True)
+            raise
+        self.metrics.end(token)
+        return res
+
+    def close(self):
+        # a coroutine for async clients
+        if hasattr(self.client, "close"):
+            return self.client.close()
+
+
+def serve_metrics(port, host="0.0.0.0", metrics=None):
+    # GET /metrics in Prometheus text format, from a daemon thread
+    metrics = metrics or registry
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("content-type", "text/plain; version=0.0.4")
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+    srv = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    log.info("metrics on http://%s:%s/metrics", host, port)
+    return srv
@@ -1,6 +1,7 @@
 # MessagePack-RPC Server/Client with mprpc module
 from ..client import ClientIf
 from ..server import ServerIf
+from ..dispatcher import call_sync
 from logging import getLogger
 import functools
 
@@ -15,7 +16,7 @@ class Server(ServerIf):
     class MPServ(mprpc.RPCServer):
         def __getattr__(self, name, dflt=None):
             log.debug("getattr %s", name)
-            return functools.partial(self.d, name)
+            return functools.partial(call_sync, self.d, name)
             # try:
             #    if hasattr(self, name):
             #        return getattr(self, name, dflt)
@@ -23,6 +24,7 @@ class Server(ServerIf):
             #    return functools.partial(self.d, self, name)
 
     def serve(self, dispatcher):
+        dispatcher = self.wrap_dispatcher(dispatcher)
         # does not work
         srv = Server.MPServ()
         srv.d = dispatcher
@@ -1 +1 @@
-from .rpc import Client, Server
+from .rpc import Client, Server, AsyncClient
@@ -1,54 +1,91 @@
 # MessagePack-RPC Server/Client
 from ..server import ServerIf
-from ..client import ClientIf
+from ..client import ClientIf, AsyncClientIf
+import msgpack
 import msgpackrpc
+from msgpackrpc.transport import tcp
+import asyncio
+import socket
 import functools
 import threading
+import types
 from logging import getLogger
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
 
 log = getLogger(__name__)
 
 
-def conv(s, encoding='utf-8'):
-    if isinstance(s, dict):
-        res = {}
-        for k, v in s.items():
-            if isinstance(k, bytes):
-                res[k.decode(encoding)] = conv(v, encoding)
-            else:
-                res[k] = conv(v, encoding)
-        return res
-    if isinstance(s, bytes):
-        return s.decode(encoding)
-    if isinstance(s, (list, tuple)):
-        return [conv(x, encoding) for x in s]
-    return s
+class BinarySocket(tcp.ServerSocket):
+    # msgpackrpc packs with encoding=, which turns bytes into raw strings.
+    # use the bin type both ways so bytes/bytearray/memoryview pass as is
+    def __init__(self, stream, transport, encodings):
+        self._stream = stream
+        self._packer = msgpack.Packer(
+            use_bin_type=True, default=lambda x: x.to_msgpack())
+        self._unpacker = msgpack.Unpacker(raw=False)
+        self._transport = transport
+        self._stream.read_until_close(self.on_read, self.on_read)
+
+
+class BinaryMPServer(tcp.MessagePackServer):
+    def handle_stream(self, stream, address):
+        BinarySocket(stream, self._transport, self._encodings)
+
+
+class BinaryTransport(tcp.ServerTransport):
+    def listen(self, server):
+        self._server = server
+        self._mp_server = BinaryMPServer(
+            self, io_loop=self._server._loop._ioloop, encodings=self._encodings)
+        self._mp_server.listen(self._address.port)
+
+
+# msgpackrpc.Server only needs builder.ServerTransport
+binary_builder = types.SimpleNamespace(ServerTransport=BinaryTransport)
 
 
 class Server(ServerIf):
+    # params: binary=False to keep msgpackrpc's str packing for old clients
     class MPServ(msgpackrpc.Server):
-        executor = ThreadPoolExecutor()
-
-        def __init__(self, dispatcher):
-            super().__init__(dispatcher, pack_encoding='utf-8', unpack_encoding='utf-8')
+        def __init__(self, dispatcher, binary=True):
+            if binary:
+                super().__init__(dispatcher, builder=binary_builder)
+            else:
+                super().__init__(dispatcher, pack_encoding='utf-8', unpack_encoding='utf-8')
 
-        def initialize(self, d):
+        def initialize(self, d, srv):
             self.d = d
+            self.srv = srv
 
         def done_async(self, responder, result):
-            responder.set_result(result.result(), None)
+            # runs in a pool thread: tornado streams may only be written from the loop
+            self._loop._ioloop.add_callback(self.respond, responder, result)
+
+        def respond(self, responder, result):
+            e = result.exception()
+            if e is not None:
+                log.debug("error %s", e)
+                responder.set_error(str(e))
+            else:
+                responder.set_result(result.result(), None)
 
         def dispatch(self, method, param, responder):
             log.debug("got %s %s %s", method, param, responder)
             method = msgpackrpc.compat.force_str(method)
-            ft = Server.MPServ.executor.submit(self.d, method, *param)
+            try:
+                ft = self.srv.submit(method, *param)
+            except Exception as e:
+                log.debug("error %s %s", method, e)
+                responder.set_error(str(e))
+                return
             ft.add_done_callback(functools.partial(
                 self.done_async, responder))
 
     def serve(self, dispatcher):
-        mpsrv = Server.MPServ(None)
-        mpsrv.initialize(dispatcher)
+        dispatcher = self.wrap_dispatcher(dispatcher)
+        self.start_executor(dispatcher)
+        mpsrv = Server.MPServ(None, self.params.get("binary", True))
+        mpsrv.initialize(dispatcher, self)
         # srv = msgpackrpc.Server(mpsrv)
         mpsrv.listen(msgpackrpc.Address(
             self.addr_parsed.hostname, self.addr_parsed.port))
@@ -60,14 +97,180 @@ class Server(ServerIf):
 
 
 class Client(ClientIf):
+    # one connection per client: requests are pipelined and a reader
+    # thread hands responses back to futures by msgid
     def __init__(self, addr: str, params: dict = {}):
         super().__init__(addr, params)
-        self.tl = threading.local()
+        # seconds per call (10, as msgpackrpc.Client), None: wait forever
+        self.timeout = self.params.get("timeout", 10)
+        self.lock = threading.Lock()    # sock, msgid, waiting
+        self.wlock = threading.Lock()   # socket writes
+        self.sock = None
+        self.msgid = 0
+        self.waiting = {}
+
+    def connect(self):
+        # with self.lock held
+        if self.sock is None:
+            log.debug("connect host=%s port=%s",
+                      self.addr_parsed.hostname, self.addr_parsed.port)
+            sock = socket.create_connection(
+                (self.addr_parsed.hostname, self.addr_parsed.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.recv, args=(sock,), daemon=True).start()
+            self.sock = sock
+        return self.sock
+
+    def recv(self, sock):
+        unpacker = msgpack.Unpacker(raw=False)
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                unpacker.feed(data)
+                for msg in unpacker:
+                    self.on_response(msg)
+        except Exception as e:
+            log.debug("recv error %s", e)
+        finally:
+            log.debug("disconnected")
+            self.disconnect(sock)
+
+    def disconnect(self, sock):
+        with self.lock:
+            if self.sock is not sock:
+                return
+            self.sock = None
+            waiting, self.waiting = self.waiting, {}
+        sock.close()
+        for ft in waiting.values():
+            ft.set_exception(ConnectionError("connection closed"))
+
+    def on_response(self, msg):
+        _, msgid, error, result = msg
+        with self.lock:
+            ft = self.waiting.pop(msgid, None)
+        if ft is None:
+            log.debug("unknown msgid %s", msgid)
+            return
+        if error is not None:
+            ft.set_exception(Exception(error))
+        else:
+            ft.set_result(result)
+
+    def submit(self, method: str, params=None):
+        return self.submit_many([(method, params)])[0]
+
+    def submit_many(self, calls):
+        # [(method, params), ...] -> futures, all requests in one write
+        log.debug("call %s", calls)
+        fts = [Future() for _ in calls]
+        with self.lock:
+            sock = self.connect()
+            msgids = []
+            for ft in fts:
+                msgids.append(self.msgid)
+                self.waiting[self.msgid] = ft
+                self.msgid = (self.msgid + 1) & 0xffffffff
+        packer = msgpack.Packer(use_bin_type=True)
+        data = b"".join(packer.pack([0, msgid, method, [params]])
+                        for msgid, (method, params) in zip(msgids, calls))
+        try:
+            with self.wlock:
+                sock.sendall(data)
+        except OSError:
+            self.disconnect(sock)
+            raise
+        return fts
 
     def call(self, method: str, params=None):
+        return self.submit(method, params).result(self.timeout)
+
+    def close(self):
+        with self.lock:
+            sock = self.sock
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+            self.disconnect(sock)
+
+    def __getstate__(self):
+        return {"addr": self.addr, "params": self.params}
+
+    def __setstate__(self, state):
+        self.__init__(state["addr"], state["params"])
+
+
+class AsyncClient(AsyncClientIf):
+    # requests are written without waiting and answered by msgid,
+    # so any number of calls share one connection
+    def __init__(self, addr: str, params: dict = {}):
+        super().__init__(addr, params)
+        self.conn = None
+        self.reader = None
+        self.msgid = 0
+        self.waiting = {}
+
+    async def open(self):
+        reader, writer = await asyncio.open_connection(
+            self.addr_parsed.hostname, self.addr_parsed.port)
+        self.reader = asyncio.ensure_future(self.recv(reader))
+        return writer
+
+    async def connect(self):
+        if self.conn is None:
+            self.conn = asyncio.ensure_future(self.open())
+        try:
+            return await self.conn
+        except Exception:
+            self.conn = None
+            raise
+
+    async def recv(self, reader):
+        unpacker = msgpack.Unpacker(raw=False)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                unpacker.feed(data)
+                for msg in unpacker:
+                    self.on_response(msg)
+        except Exception as e:
+            log.debug("recv error %s", e)
+        finally:
+            log.debug("disconnected")
+            self.conn = None
+            waiting, self.waiting = self.waiting, {}
+            for ft in waiting.values():
+                if not ft.done():
+                    ft.set_exception(ConnectionError("connection closed"))
+
+    def on_response(self, msg):
+        _, msgid, error, result = msg
+        ft = self.waiting.pop(msgid, None)
+        if ft is None or ft.done():
+            log.debug("unknown msgid %s", msgid)
+            return
+        if error is not None:
+            ft.set_exception(Exception(error))
+        else:
+            ft.set_result(result)
+
+    async def call(self, method: str, params=None):
         log.debug("call %s %s", method, params)
-        if not hasattr(self.tl, "cl"):
-            self.tl.cl = msgpackrpc.Client(msgpackrpc.Address(
-                self.addr_parsed.hostname, self.addr_parsed.port),
-                pack_encoding='utf-8', unpack_encoding='utf-8')
-        return self.tl.cl.call(method, params)
+        writer = await self.connect()
+        msgid = self.msgid
+        self.msgid = (self.msgid + 1) & 0xffffffff
+        ft = asyncio.get_event_loop().create_future()
+        self.waiting[msgid] = ft
+        writer.write(msgpack.packb([0, msgid, method, [params]], use_bin_type=True))
+        await writer.drain()
+        return await ft
+
+    async def close(self):
+        if self.conn is not None:
+            writer = await self.conn
+            writer.close()
+            await self.reader
+            self.conn = None
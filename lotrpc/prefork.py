@@ -0,0 +1,110 @@
+# pre-forked workers sharing one listening socket
+import os
+import sys
+import time
+import signal
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+
+log = getLogger(__name__)
+
+
+def bind(host, port, backlog=128):
+    family = socket.AF_INET6 if host is not None and ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if os.name != "nt":
+            # windows: SO_REUSEADDR would allow two servers on one port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host or "", port))
+        sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class Prefork:
+    grace = 10            # seconds between SIGTERM and SIGKILL on shutdown
+    restart_interval = 1  # min seconds between restarts of a crashing worker
+
+    def __init__(self, server, dispatcher, workers):
+        self.server = server
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.children = {}   # pid -> start time
+        self.stopping = None
+        self.killed = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = time.monotonic()
+            return
+        # worker: serve on the inherited socket until told to stop
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        code = 0
+        try:
+            for fn in self.server.after_fork:
+                fn()
+            self.server.serve(self.dispatcher)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            log.exception("worker %d failed", os.getpid())
+            code = 1
+        finally:
+            self.cleanup()
+            os._exit(code)
+
+    def cleanup(self):
+        # os._exit skips atexit: stop the worker's own process pools, or they are orphaned
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for fn in self.server.before_exit:
+            try:
+                fn()
+            except Exception:
+                log.exception("worker %d cleanup", os.getpid())
+        if isinstance(self.server.executor, ProcessPoolExecutor):
+            self.server.executor.shutdown()
+
+    def stop(self, signum, frame):
+        if self.stopping is None:
+            log.info("stop workers")
+            self.stopping = time.monotonic()
+            for pid in self.children:
+                os.kill(pid, signal.SIGTERM)
+
+    def reap(self):
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            return False
+        started = self.children.pop(pid, None)
+        if started is not None and self.stopping is None:
+            log.warning("worker %d exited (status %d), restart", pid, status)
+            if time.monotonic() - started < self.restart_interval:
+                # crashed right after start: do not spin
+                time.sleep(self.restart_interval)
+            self.spawn()
+        return True
+
+    def run(self):
+        self.server.sock = bind(self.server.addr_parsed.hostname, self.server.addr_parsed.port)
+        log.info("listen %s, %d workers", self.server.sock.getsockname(), self.workers)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for i in range(self.workers):
+            self.spawn()
+        while self.children:
+            if self.stopping is not None and not self.killed and \
+                    time.monotonic() - self.stopping > self.grace:
+                for pid in self.children:
+                    log.warning("kill worker %d", pid)
+                    os.kill(pid, signal.SIGKILL)
+                self.killed = True
+            if not self.reap():
+                time.sleep(0.1)
+        self.server.sock.close()
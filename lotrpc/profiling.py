@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import functools
+import itertools
+import threading
+import tracemalloc
+from concurrent.futures import Future
+from logging import getLogger
+from .metrics import Histogram, perf_counter_ns
+from .dispatcher import is_async
+
+log = getLogger(__name__)
+
+__all__ = ["Profiler", "ProfileDispatcher", "profile_method"]
+
+profile_method = "_lotrpc.profile"
+
+# set per request by servers that time decode/encode themselves (json):
+# the Sample of a profiled request, False if not sampled. None: let the dispatcher sample.
+# python 3.6 has no contextvars: the dispatcher always samples by itself
+try:
+    import contextvars
+    current = contextvars.ContextVar("lotrpc_profile", default=None)
+except ImportError:
+    current = None
+
+
+class Sample:
+    # wall time of one request by stage
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.ts = perf_counter_ns()
+        self.stages = []
+
+    def mark(self, stage):
+        # time since the previous mark (or the start) goes to stage
+        now = perf_counter_ns()
+        self.stages.append((stage, now - self.ts))
+        self.ts = now
+
+    def done(self, method):
+        self.profiler.record(method, self.stages)
+
+
+class Profiler:
+    # params:
+    #   profile: profile 1 in N requests (0: off)
+    #   profile_mode: time (wall time by stage, default), cprofile or tracemalloc
+    #   profile_file: write the report (JSON) every profile_interval seconds (60);
+    #     "{pid}" is replaced by the process id. cprofile also writes <file>.prof (pstats)
+    #   profile_top: functions or allocation sites in the report (20)
+    # stages: decode, dispatch (including the executor hop), encode (json server only),
+    # call (the dispatcher itself), alloc (peak bytes, tracemalloc)
+    max_methods = 1000
+
+    def __init__(self, params: dict = {}):
+        self.every = params.get("profile", 0)
+        self.mode = params.get("profile_mode", "time")
+        if self.mode not in ("time", "cprofile", "tracemalloc"):
+            raise Exception("unknown profile_mode: {}".format(self.mode))
+        self.file = params.get("profile_file", None)
+        self.interval = params.get("profile_interval", 60)
+        self.top = params.get("profile_top", 20)
+        self.count = itertools.count()
+        self.lock = threading.Lock()
+        # cProfile and tracemalloc are process-wide: one profiled call at a time,
+        # other sampled calls are only timed
+        self.busy = threading.Lock()
+        self.dumper_pid = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}   # method -> {stage: Histogram}
+            self.stats = None   # pstats.Stats
+            self.allocs = {}    # "file:line" -> bytes
+
+    def tick(self):
+        return next(self.count) % self.every == 0
+
+    def begin(self):
+        # json server: decide for the whole request, the dispatcher follows
+        s = Sample(self) if self.tick() else None
+        if current is not None:
+            current.set(s or False)
+        return s
+
+    def bind(self, fn):
+        # fn to run in an executor thread, seeing this request's decision
+        if current is None:
+            return fn
+        return functools.partial(contextvars.copy_context().run, fn)
+
+    def record(self, method, stages):
+        with self.lock:
+            st = self.methods.get(method)
+            if st is None:
+                if len(self.methods) >= self.max_methods:
+                    method = "_other"
+                st = self.methods.setdefault(method, {})
+            for stage, v in stages:
+                h = st.get(stage)
+                if h is None:
+                    h = st[stage] = Histogram()
+                h.record(v)
+
+    def run(self, d, method, params):
+        # a sampled sync call
+        self.start_dumper()
+        if self.mode == "time" or not self.busy.acquire(blocking=False):
+            ts = perf_counter_ns()
+            try:
+                return d(method, params)
+            finally:
+                self.record(method, [("call", perf_counter_ns() - ts)])
+        try:
+            if self.mode == "cprofile":
+                return self.run_cprofile(d, method, params)
+            return self.run_tracemalloc(d, method, params)
+        finally:
+            self.busy.release()
+
+    def run_cprofile(self, d, method, params):
+        pr = cProfile.Profile()
+        ts = perf_counter_ns()
+        pr.enable()
+        try:
+            return d(method, params)
+        finally:
+            pr.disable()
+            self.record(method, [("call", perf_counter_ns() - ts)])
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(pr)
+                else:
+                    self.stats.add(pr)
+
+    def run_tracemalloc(self, d, method, params):
+        # allocations of other threads during the call are counted too
+        started = not tracemalloc.is_tracing()
+        # python < 3.9 cannot reset the peak of a running trace: net growth instead
+        reset = hasattr(tracemalloc, "reset_peak")
+        if started:
+            tracemalloc.start()
+        elif reset:
+            tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        ts = perf_counter_ns()
+        try:
+            return d(method, params)
+        finally:
+            elapsed = perf_counter_ns() - ts
+            cur, peak = tracemalloc.get_traced_memory()
+            peak = (peak if started or reset else cur) - base
+            snap = tracemalloc.take_snapshot() if started else None
+            if started:
+                tracemalloc.stop()
+            self.record(method, [("call", elapsed), ("alloc", max(peak, 0))])
+            if snap is not None:
+                with self.lock:
+                    for x in snap.statistics("lineno")[:self.top]:
+                        k = str(x.traceback)
+                        self.allocs[k] = self.allocs.get(k, 0) + x.size
+
+    def report(self, reset=False):
+        res = {"every": self.every, "mode": self.mode, "methods": {}}
+        with self.lock:
+            for method, st in self.methods.items():
+                res["methods"][method] = {stage: hist_summary(stage, h) for stage, h in st.items()}
+            if self.stats is not None:
+                funcs = sorted(self.stats.stats.items(), key=lambda x: -x[1][3])[:self.top]
+                res["functions"] = [{
+                    "function": "{}:{}({})".format(*f),
+                    "calls": nc, "tottime_ms": tt * 1000, "cumtime_ms": ct * 1000,
+                } for f, (cc, nc, tt, ct, callers) in funcs]
+            if self.allocs:
+                top = sorted(self.allocs.items(), key=lambda x: -x[1])[:self.top]
+                res["allocations"] = [{"line": k, "bytes": v} for k, v in top]
+        if reset:
+            self.reset()
+        return res
+
+    def dump(self):
+        path = self.file.replace("{pid}", str(os.getpid()))
+        res = self.report()
+        with open(path + ".tmp", "w") as ofp:
+            json.dump(res, ofp, indent=2)
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            if self.stats is not None:
+                self.stats.dump_stats(path + ".prof")
+
+    def dumper(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except Exception as e:
+                log.warning("profile dump: %s", e)
+
+    def start_dumper(self):
+        # one thread per process
+        if self.file is None or self.dumper_pid == os.getpid():
+            return
+        with self.lock:
+            if self.dumper_pid != os.getpid():
+                threading.Thread(target=self.dumper, daemon=True).start()
+                self.dumper_pid = os.getpid()
+
+
+def hist_summary(stage, h):
+    if stage == "alloc":
+        return {"count": h.count, "mean_bytes": h.sum / h.count, "p50_bytes": h.percentile(0.5),
+                "p99_bytes": h.percentile(0.99), "max_bytes": h.max}
+    return {"count": h.count, "mean_ms": h.sum / h.count / 1e6,
+            "p50_ms": h.percentile(0.5) / 1e6, "p99_ms": h.percentile(0.99) / 1e6,
+            "max_ms": h.max / 1e6}
+
+
+class ProfileDispatcher:
+    # wraps a dispatcher: times (and profiles) sampled calls, answers _lotrpc.profile
+    # with the report. params of _lotrpc.profile: {"reset": true} clears it after
+    def __init__(self, d, profiler):
+        self.d = d
+        self.profiler = profiler
+
+    def is_async(self, method):
+        return method != profile_method and is_async(self.d, method)
+
+    def answer(self, params):
+        return self.profiler.report(isinstance(params, dict) and params.get("reset", False))
+
+    def __call__(self, method, params):
+        if method == profile_method:
+            return self.answer(params)
+        s = current.get() if current is not None else None
+        if s is None:
+            s = self.profiler.tick()
+        if not s:
+            return self.d(method, params)
+        if is_async(self.d, method):
+            return self.wait(method, self.d(method, params), perf_counter_ns())
+        return self.profiler.run(self.d, method, params)
+
+    async def wait(self, method, res, ts):
+        try:
+            return await res
+        finally:
+            self.profiler.record(method, [("call", perf_counter_ns() - ts)])
+
+    def submit(self, executor, fn, method, params):
+        # process pool: the workers run the bare dispatcher, only time the call here
+        if method == profile_method:
+            ft = Future()
+            ft.set_result(self.answer(params))
+            return ft
+        if not self.profiler.tick():
+            return executor.submit(fn, method, params)
+        self.profiler.start_dumper()
+        ts = perf_counter_ns()
+        ft = executor.submit(fn, method, params)
+        ft.add_done_callback(
+            lambda x: self.profiler.record(method, [("call", perf_counter_ns() - ts)]))
+        return ft
@@ -1,5 +1,9 @@
 import time
-from logging import getLogger, INFO
+import asyncio
+from logging import getLogger
+from .cache import CachingClient
+from .batch import BatchingClient
+from .accesslog import AccessLog
 
 log = getLogger(__name__)
 
@@ -10,6 +14,9 @@ class Proxy:
         self.client = client
 
     def serve(self):
+        if self.server.params.get("metrics", False):
+            from .metrics import MetricsClient
+            self.client = MetricsClient(self.client, "upstream")
         self.server.serve(self.dispatcher)
 
     def paramfilter(self, method, param):
@@ -20,14 +27,66 @@ class Proxy:
         return self.client.call(m, p)
 
 
-class LoggingProxy(Proxy):
-    def __init__(self, server, client):
+class AsyncProxy(Proxy):
+    # for event-loop servers (json, aiojson, aioxml): each request awaits the
+    # upstream AsyncClient on the server loop instead of holding a thread.
+    # a plain Client works too, through its asynccall() executor
+    async def dispatcher(self, method: str, params=None):
+        m, p = self.paramfilter(method, params)
+        # get_event_loop: the running loop (get_running_loop is python 3.7+)
+        return await self.client.asynccall(asyncio.get_event_loop(), m, p)
+
+
+class BatchingProxy(Proxy):
+    # micro-batching to upstreams with call_batch (json) or submit_many (msgpack).
+    # params: see BatchingClient
+    def __init__(self, server, client, params: dict = {}):
         super().__init__(server, client)
-        log.setLevel(INFO)
+        self.client = BatchingClient(client, params)
+
+
+class LoggingProxy(Proxy):
+    # access log to the "lotrpc.access" logger (enable it with level INFO).
+    # log_params: see AccessLog
+    def __init__(self, server, client, *args, log_params: dict = {}):
+        super().__init__(server, client, *args)
+        self.access = AccessLog(log_params)
 
     def dispatcher(self, method: str, params=None):
-        ts = time.time()
-        res = super().dispatcher(method, params)
-        log.info("%s %.3f arg=%s, res=%s", method,
-                 time.time() - ts, params, res)
+        if not self.access.enabled():
+            return super().dispatcher(method, params)
+        ts = time.perf_counter()
+        try:
+            res = super().dispatcher(method, params)
+        except Exception as e:
+            self.access.put(method, params, None, time.perf_counter() - ts, e)
+            raise
+        self.access.put(method, params, res, time.perf_counter() - ts)
         return res
+
+
+class CachingProxy(Proxy):
+    # params: ttl {method: seconds}, default_ttl, store (memory/sqlite), path, max_size.
+    # sqlite store is shared by all workers using the same path.
+    # identical in-flight calls are coalesced within a process
+    invalidate_method = "_lotrpc.cache.invalidate"
+    stats_method = "_lotrpc.cache.stats"
+
+    def __init__(self, server, client, params: dict = {}):
+        super().__init__(server, client)
+        self.client = CachingClient(client, params)
+
+    def dispatcher(self, method: str, params=None):
+        if method == self.invalidate_method:
+            # params: {} all, {"method": m} one method, {"method": m, "params": p} one call
+            params = params or {}
+            self.client.invalidate(params.get("method"), params.get("params"))
+            return {}
+        if method == self.stats_method:
+            return self.client.stats()
+        return super().dispatcher(method, params)
+
+
+class CachingLoggingProxy(LoggingProxy, CachingProxy):
+    # access log of all requests, cached or not
+    pass
@@ -1,21 +1,153 @@
+import os
+import sys
+import hmac
+import hashlib
 import bcrypt
 import secrets
+import signal
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 from logging import getLogger
 from .proxy import Proxy
+from .tokenstore import new_token_store
 
 log = getLogger(__name__)
 
 
+def check_password(password: bytes, hashed: bytes):
+    # runs in the hash worker processes
+    return bcrypt.checkpw(password, hashed)
+
+
 class LoginProxy(Proxy):
     unauth_method = ["login", "logout"]
     token_key = "auth"
     pwd_store = {
         "testuser": bcrypt.hashpw(b"testpassword", bcrypt.gensalt(rounds=10, prefix=b'2a')),
     }
-    token_store = {}
     token_expire = 3600
     token_update = True
+    sweep_interval = 60
+
+    # params:
+    #   hash_workers: processes for bcrypt (2, 0: in the dispatch thread)
+    #   max_logins: logins verifying at once, more are refused (2 * hash_workers, or 1).
+    #     keep it below the server's max_workers so other requests always get threads
+    #   verify_cache_ttl: seconds a verified password is accepted without bcrypt (60)
+    #   login_rate, login_burst: password checks per second per user (0.2) and burst (5)
+    #   token_store: memory (default) or sqlite (token_db: file shared by proxy processes),
+    #   max_tokens: tokens kept, the ones closest to expiry are dropped first (100000)
+    #   sweep_interval: seconds between expired token sweeps (60)
+    def __init__(self, server, client, params: dict = {}):
+        super().__init__(server, client)
+        self.params = params
+        self.hash_workers = params.get("hash_workers", 2)
+        self.login_slots = threading.BoundedSemaphore(
+            params.get("max_logins", 2 * self.hash_workers or 1))
+        self.verify_cache_ttl = params.get("verify_cache_ttl", 60)
+        self.login_rate = params.get("login_rate", 0.2)
+        self.login_burst = params.get("login_burst", 5)
+        self.lock = threading.Lock()
+        self.verified = {}      # username -> (hmac of password, pw hash, expire)
+        self.buckets = {}       # username -> (tokens, last update)
+        self.secret = secrets.token_bytes(32)
+        self.pool = None
+        self.pool_pid = None
+        self.token_store = new_token_store(params)
+        self.sweep_interval = params.get("sweep_interval", self.sweep_interval)
+        self.sweeper_pid = None
+
+    def hash_pool(self):
+        # one pool per process (pre-forked workers create their own)
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(self.hash_workers)
+                self.pool_pid = os.getpid()
+                # fork the workers now, see serve()
+                self.pool.submit(int).result()
+            return self.pool
+
+    def close_pool(self):
+        with self.lock:
+            if self.pool is not None and self.pool_pid == os.getpid():
+                self.pool.shutdown()
+            self.pool = None
+
+    def serve(self):
+        # fork the bcrypt workers before the server starts its threads
+        # (pre-forked servers: in each worker process, before it serves)
+        if self.hash_workers:
+            if self.server.params.get("workers", 1) > 1:
+                self.server.after_fork.append(self.hash_pool)
+                self.server.before_exit.append(self.close_pool)
+            else:
+                self.hash_pool()
+                # SIGTERM would kill the process before the pool is shut down
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            super().serve()
+        finally:
+            self.close_pool()
+
+    def pw_digest(self, username, password):
+        # the cache keeps a keyed digest, not the password
+        return hmac.new(self.secret, (username + "\0" + password).encode("utf-8"),
+                        hashlib.sha256).digest()
+
+    def is_verified(self, username, digest, pw):
+        with self.lock:
+            ent = self.verified.get(username)
+            if ent is None:
+                return False
+            if ent[2] < time.monotonic() or ent[1] != pw:
+                # expired, or the password was changed
+                self.verified.pop(username, None)
+                return False
+            return hmac.compare_digest(ent[0], digest)
+
+    def allow_attempt(self, username):
+        # token bucket per user
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(username, (self.login_burst, now))
+            tokens = min(self.login_burst, tokens + (now - last) * self.login_rate)
+            if tokens < 1:
+                self.buckets[username] = (tokens, now)
+                return False
+            self.buckets[username] = (tokens - 1, now)
+            if len(self.buckets) > 100000:
+                # drop full buckets, they are the same as no entry
+                full = [k for k, v in self.buckets.items()
+                        if v[0] + (now - v[1]) * self.login_rate >= self.login_burst]
+                for k in full:
+                    del self.buckets[k]
+            return True
+
+    def verify(self, username, password, pw):
+        # -> error message or None
+        digest = self.pw_digest(username, password)
+        if self.is_verified(username, digest, pw):
+            return None
+        if not self.allow_attempt(username):
+            log.info("login rate limit: %s", username)
+            return "too many login attempts"
+        if not self.login_slots.acquire(blocking=False):
+            log.info("too many logins: %s", username)
+            return "server busy, retry later"
+        try:
+            if self.hash_workers:
+                ok = self.hash_pool().submit(check_password, password.encode("utf-8"), pw).result()
+            else:
+                ok = check_password(password.encode("utf-8"), pw)
+        finally:
+            self.login_slots.release()
+        if not ok:
+            return "invalid username or password"
+        if self.verify_cache_ttl:
+            with self.lock:
+                self.verified[username] = (digest, pw, time.monotonic() + self.verify_cache_ttl)
+        return None
 
     def login(self, params):
         username = params.get("username", None)
@@ -25,33 +157,55 @@ class LoginProxy(Proxy):
         pw = self.pwd_store.get(username, None)
         if pw is None:
             return {"error": "invalid username or password"}
-        if not bcrypt.checkpw(password.encode("utf-8"), pw):
-            return {"error": "invalid username or password"}
+        err = self.verify(username, password, pw)
+        if err is not None:
+            return {"error": err}
         # generate token
         token = secrets.token_urlsafe()
-        self.token_store[token] = (username, time.time())
+        self.token_store.put(token, username, time.time() + self.token_expire)
         return {
             self.token_key: token,
         }
 
     def logout(self, params):
         token = params.get(self.token_key, None)
-        if token in self.token_store:
-            self.token_store.pop(token)
+        if token is not None:
+            self.token_store.delete(token)
         return {}
 
     def _check_token(self, token):
-        if token in self.token_store:
-            user, ts = self.token_store[token]
-            if ts - time.time() > self.token_expire:
-                self.token_store.pop(token)
-                return None
-            if self.token_update:
-                self.token_store[token] = (user, time.time())
-            return user
-        return None
+        if token is None:
+            return None
+        ent = self.token_store.get(token)
+        if ent is None:
+            return None
+        user, expire = ent
+        if self.token_update:
+            # sliding expiry, written at most every 1/10 of token_expire
+            now = time.time()
+            if now + self.token_expire - expire > self.token_expire / 10:
+                self.token_store.touch(token, now + self.token_expire)
+        return user
+
+    def sweeper(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                n = self.token_store.sweep()
+                log.debug("swept %d tokens", n)
+            except Exception as e:
+                log.warning("token sweep: %s", e)
+
+    def start_sweeper(self):
+        # one thread per process (threads do not survive fork)
+        if self.sweeper_pid != os.getpid():
+            with self.lock:
+                if self.sweeper_pid != os.getpid():
+                    threading.Thread(target=self.sweeper, daemon=True).start()
+                    self.sweeper_pid = os.getpid()
 
     def dispatcher(self, method: str, params: dict = {}):
+        self.start_sweeper()
         if method in self.unauth_method:
             return getattr(self, method)(params)
         username = self._check_token(params.get(self.token_key, None))
@@ -1,10 +1,32 @@
 import urllib.parse
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .dispatcher import call_sync
+
+log = getLogger(__name__)
+
+# dispatcher of a process-pool worker, set once by the pool initializer
+worker_dispatcher = None
+
+
+def worker_init(d):
+    global worker_dispatcher
+    worker_dispatcher = d
+
+
+def worker_call(method, params):
+    return call_sync(worker_dispatcher, method, params)
 
 
 class ServerIf:
     def __init__(self, addr: str, params: dict = {}):
         self.addr = addr      # URL or host:port
         self.params = params  # options
+        self.executor = None
+        self.sock = None      # listening socket inherited from a pre-fork parent
+        self.profiler = None
+        self.after_fork = []  # called in each pre-forked worker before it serves
+        self.before_exit = []  # called in each pre-forked worker when it stops
         try:
             if addr.find("/") == -1:
                 addr = "//" + addr
@@ -12,5 +34,82 @@ class ServerIf:
         except Exception:
             pass
 
+    def start_executor(self, dispatcher):
+        # params: executor ("thread" or "process"), max_workers
+        mode = self.params.get("executor", "thread")
+        workers = self.params.get("max_workers", None)
+        if mode == "thread":
+            self.executor = ThreadPoolExecutor(workers)
+        elif mode == "process":
+            # the dispatcher is pickled once per worker process, not per call
+            from .metrics import MetricsDispatcher
+            from .profiling import ProfileDispatcher
+            inner = dispatcher
+            while isinstance(inner, (MetricsDispatcher, ProfileDispatcher)):
+                inner = inner.d
+            self.executor = ProcessPoolExecutor(
+                workers, initializer=worker_init, initargs=(inner,))
+            # start workers now, before the server spawns its own threads
+            self.executor.submit(int).result()
+        else:
+            raise Exception("unknown executor: {}".format(mode))
+        self.dispatcher = dispatcher
+        return self.executor
+
+    def submit(self, method, params):
+        if isinstance(self.executor, ProcessPoolExecutor):
+            if hasattr(self.dispatcher, "submit"):
+                # metrics and profiles are kept in this process
+                return self.dispatcher.submit(self.executor, worker_call, method, params)
+            return self.executor.submit(worker_call, method, params)
+        if self.profiler is not None:
+            # the worker thread needs to know if this request is profiled
+            return self.executor.submit(
+                self.profiler.bind(call_sync), self.dispatcher, method, params)
+        return self.executor.submit(call_sync, self.dispatcher, method, params)
+
+    def profile_sample(self):
+        # for servers timing decode/encode: a Sample if this request is profiled
+        if self.profiler is None:
+            return None
+        return self.profiler.begin()
+
+    def wrap_dispatcher(self, dispatcher):
+        # params: metrics (per-method counters and latency, _lotrpc.metrics method),
+        # metrics_port (also serve GET /metrics there, single process only),
+        # profile (profile 1 in N requests, _lotrpc.profile method, see Profiler).
+        # without them the dispatcher is used as is
+        metrics = self.params.get("metrics", False)
+        profile = self.params.get("profile", 0)
+        if not metrics and not profile:
+            return dispatcher
+        from .metrics import MetricsDispatcher, serve_metrics
+        from .profiling import Profiler, ProfileDispatcher
+        if isinstance(dispatcher, (MetricsDispatcher, ProfileDispatcher)):
+            return dispatcher
+        if profile:
+            self.profiler = Profiler(self.params)
+            dispatcher = ProfileDispatcher(dispatcher, self.profiler)
+        if not metrics:
+            return dispatcher
+        port = self.params.get("metrics_port", None)
+        if port is not None:
+            if self.params.get("workers", 1) > 1:
+                log.warning("metrics_port is not available with workers, use %s",
+                            "_lotrpc.metrics")
+            else:
+                serve_metrics(port)
+        return MetricsDispatcher(dispatcher)
+
+    def prefork(self, dispatcher):
+        # params: workers (>1: serve from that many forked processes).
+        # returns False when this process should serve by itself
+        workers = self.params.get("workers", 1)
+        if self.sock is not None or workers <= 1:
+            return False
+        from .prefork import Prefork
+        Prefork(self, dispatcher, workers).run()
+        return True
+
     def serve(self, dispatcher):
         pass
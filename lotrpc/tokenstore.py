@@ -0,0 +1,136 @@
+import time
+import heapq
+import threading
+from logging import getLogger
+from .cache import sqlite_conn
+
+log = getLogger(__name__)
+
+
+class MemoryTokenStore:
+    # token -> (user, expire) with an expiry heap: sweep and eviction are O(log n)
+    # per token. touch() pushes a new heap entry; stale ones are skipped when popped
+    def __init__(self, max_tokens=100000):
+        self.max_tokens = max_tokens
+        self.tokens = {}
+        self.heap = []      # (expire, token)
+        self.lock = threading.Lock()
+
+    def put(self, token, user, expire):
+        with self.lock:
+            self.tokens[token] = (user, expire)
+            heapq.heappush(self.heap, (expire, token))
+            while len(self.tokens) > self.max_tokens:
+                # full: drop the token closest to expiry
+                self.pop_expired(None)
+
+    def get(self, token):
+        # -> (user, expire) or None
+        with self.lock:
+            ent = self.tokens.get(token)
+            if ent is None:
+                return None
+            if ent[1] < time.time():
+                del self.tokens[token]
+                return None
+            return ent
+
+    def touch(self, token, expire):
+        with self.lock:
+            ent = self.tokens.get(token)
+            if ent is not None:
+                self.tokens[token] = (ent[0], expire)
+                heapq.heappush(self.heap, (expire, token))
+
+    def delete(self, token):
+        with self.lock:
+            return self.tokens.pop(token, None) is not None
+
+    def pop_expired(self, now):
+        # with self.lock held. now=None: pop one live token regardless of expiry
+        while self.heap:
+            expire, token = self.heap[0]
+            if now is not None and expire >= now:
+                return False
+            heapq.heappop(self.heap)
+            ent = self.tokens.get(token)
+            if ent is not None and ent[1] == expire:
+                del self.tokens[token]
+                return True
+        return False
+
+    def sweep(self):
+        now = time.time()
+        n = 0
+        with self.lock:
+            while self.pop_expired(now):
+                n += 1
+            if len(self.heap) > 2 * len(self.tokens) + 1024:
+                # mostly stale entries from touch()
+                self.heap = [(v[1], k) for k, v in self.tokens.items()]
+                heapq.heapify(self.heap)
+        return n
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class SqliteTokenStore:
+    # shared by all proxy processes using the same file: no sticky sessions needed.
+    # the size cap is checked every cap_interval puts
+    cap_interval = 100
+
+    def __init__(self, path, max_tokens=100000):
+        self.path = path
+        self.max_tokens = max_tokens
+        self.puts = 0
+        self.local = threading.local()
+        self.db().execute(
+            "CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY, user TEXT, expire REAL)")
+        self.db().execute("CREATE INDEX IF NOT EXISTS tokens_expire ON tokens (expire)")
+
+    def db(self):
+        return sqlite_conn(self.local, self.path)
+
+    def put(self, token, user, expire):
+        db = self.db()
+        db.execute("INSERT OR REPLACE INTO tokens (token, user, expire) VALUES (?, ?, ?)",
+                   (token, user, expire))
+        self.puts += 1
+        if self.puts % self.cap_interval != 0:
+            return
+        over = len(self) - self.max_tokens
+        if over > 0:
+            db.execute("DELETE FROM tokens WHERE token IN"
+                       " (SELECT token FROM tokens ORDER BY expire LIMIT ?)", (over, ))
+
+    def get(self, token):
+        row = self.db().execute(
+            "SELECT user, expire FROM tokens WHERE token=? AND expire>=?",
+            (token, time.time())).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def touch(self, token, expire):
+        self.db().execute("UPDATE tokens SET expire=? WHERE token=?", (expire, token))
+
+    def delete(self, token):
+        return self.db().execute("DELETE FROM tokens WHERE token=?", (token, )).rowcount != 0
+
+    def sweep(self):
+        return self.db().execute("DELETE FROM tokens WHERE expire<?", (time.time(), )).rowcount
+
+    def __len__(self):
+        return self.db().execute("SELECT count(*) FROM tokens").fetchone()[0]
+
+
+def new_token_store(params: dict = {}):
+    # params: token_store=memory (default) or sqlite, token_db (sqlite file), max_tokens
+    store = params.get("token_store", "memory")
+    if store == "memory":
+        return MemoryTokenStore(params.get("max_tokens", 100000))
+    if store == "sqlite":
+        return SqliteTokenStore(params.get("token_db", "lotrpc-token.db"),
+                                params.get("max_tokens", 100000))
+    raise Exception("unknown token store: {}".format(store))
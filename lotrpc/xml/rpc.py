@@ -1,7 +1,9 @@
 # XML-RPC Server/Client
 from ..server import ServerIf
-from ..client import ClientIf
+from ..client import ClientIf, AsyncClientIf
+from ..dispatcher import call_sync
 import threading
+import aiohttp
 import xmlrpc.server
 import xmlrpc.client
 from logging import getLogger
@@ -16,15 +18,23 @@ class Server(ServerIf):
 
         def _dispatch(self, method, params):
             log.debug("got %s %s", method, params)
-            return self.d(method, *params)
+            return call_sync(self.d, method, *params)
 
     def serve(self, d):
+        d = self.wrap_dispatcher(d)
+        if self.prefork(d):
+            return
         xs = self.XServ()
         xs.initialize(d)
         hdl = type("XHandler", (xmlrpc.server.SimpleXMLRPCRequestHandler,), {
                    "rpc_paths": (self.params.get("baseurl", self.addr_parsed.path),)})
         srv = xmlrpc.server.SimpleXMLRPCServer(
-            (self.addr_parsed.hostname, self.addr_parsed.port), requestHandler=hdl, logRequests=False)
+            (self.addr_parsed.hostname, self.addr_parsed.port), requestHandler=hdl, logRequests=False,
+            bind_and_activate=self.sock is None)
+        if self.sock is not None:
+            srv.socket.close()
+            srv.socket = self.sock
+            srv.server_address = self.sock.getsockname()
         srv.register_instance(xs)
         srv.serve_forever()
 
@@ -44,3 +54,35 @@ class Client(ClientIf):
         for k in method.split("."):
             fn = getattr(fn, k)
         return fn(params)
+
+
+class AsyncClient(AsyncClientIf):
+    hdrs = {
+        "content-type": "text/xml",
+    }
+
+    def __init__(self, addr: str, params: dict = {}):
+        super().__init__(addr, params)
+        self.pool_size = self.params.get("pool_size", 100)
+        self.timeout = self.params.get("timeout", None)
+        self.session = None
+
+    def get_session(self):
+        if self.session is None:
+            conn = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(
+                connector=conn, headers=self.hdrs,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def call(self, method: str, params=None):
+        log.debug("call %s %s", method, params)
+        data = xmlrpc.client.dumps((params,), method)
+        async with self.get_session().post(self.addr, data=data) as resp:
+            body = await resp.read()
+        return xmlrpc.client.loads(body)[0][0]
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -6,6 +6,7 @@ import zerorpc
 
 from ..client import ClientIf
 from ..server import ServerIf
+from ..dispatcher import call_sync
 
 log = getLogger(__name__)
 
@@ -27,7 +28,7 @@ class MyDict(dict):
 
     def do_call(self, method, *params, **kwargs):
         log.debug("calls: %s param=%s, kwargs=%s", method, params, kwargs)
-        return self.d(method, *params)
+        return call_sync(self.d, method, *params)
 
     def __hasattr__(self, k):
         return k in self.kv
@@ -45,6 +46,7 @@ class MyDict(dict):
 
 class Server(ServerIf):
     def serve(self, dispatcher):
+        dispatcher = self.wrap_dispatcher(dispatcher)
         log.debug("start server %s:%s", self.addr_parsed.hostname,
                   self.addr_parsed.port)
         srv = ZeroServer()